@@ -2,9 +2,13 @@
 This is an AVBin based video decoding package
 """
 import avbin
+from memory import set_memory_limit
 
 __author__ = 'Jernej Virag'
 
-def load(filename, skip_video=False, keyframes_only=False):
-    source = avbin.AVbinSource(filename, skip_video=skip_video, keyframes_only=keyframes_only)
+def load(filename, skip_video=False, keyframes_only=False, skip_audio=False,
+         audio_output=None, streams=None):
+    source = avbin.AVbinSource(filename, skip_video=skip_video, keyframes_only=keyframes_only,
+                               skip_audio=skip_audio, audio_output=audio_output,
+                               streams=streams)
     return source
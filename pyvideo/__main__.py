@@ -0,0 +1,390 @@
+'''Command line tool for inspecting and decoding media files.
+
+Run ``python -m pyvideo <command> --help`` for the options of a command.
+Every command accepts any number of files, or ``-`` to read file names from
+standard input, decodes them in parallel with ``--jobs`` and writes one JSON
+record per line to standard output as results become available.  Files
+written by ``frames`` and ``audio`` are named after the path of their
+input, e.g. ``media/a/clip.mp4`` becomes ``media_a_clip``.
+'''
+import argparse
+import json
+import os
+import Queue
+import sys
+import threading
+import time
+import wave
+
+from pyvideo import convert
+from pyvideo.audio import SAMPLE_FORMAT_U8, SAMPLE_FORMAT_S16, \
+    SAMPLE_FORMAT_S24, SAMPLE_FORMAT_S32, SAMPLE_FORMAT_FLOAT
+from pyvideo.avbin import AVbinSource
+from pyvideo.engine import DecodeEngine
+from pyvideo.exceptions import MediaException
+from pyvideo.video import VideoFormat
+
+__author__ = 'Jernej Virag'
+
+_END = object()
+
+_names_lock = threading.Lock()
+
+def _describe(index, stream_format):
+    if isinstance(stream_format, VideoFormat):
+        return {
+            'index': index,
+            'type': 'video',
+            'width': stream_format.width,
+            'height': stream_format.height,
+            'sample_aspect': stream_format.sample_aspect,
+        }
+    return {
+        'index': index,
+        'type': 'audio',
+        'channels': stream_format.channels,
+        'sample_rate': stream_format.sample_rate,
+        'sample_size': stream_format.sample_size,
+        'sample_format': stream_format.sample_format,
+    }
+
+def probe(filename, args):
+    '''Yield the duration and decodable streams of a file.'''
+    source = AVbinSource(filename, streams='all')
+    yield {
+        'file': filename,
+        'duration': source.duration,
+        'streams': [_describe(index, stream_format) for index, stream_format
+                    in sorted(source.stream_formats.items())],
+    }
+
+def _output_name(filename, args):
+    '''Return the base name of the output files for `filename`.
+
+    Names are built from the whole path of the input, so that files with
+    the same name in different directories do not overwrite each other,
+    and are made unique among all inputs of the run.
+    '''
+    path = os.path.splitext(os.path.normpath(filename))[0]
+    parts = [part for part in path.replace('\\', '/').split('/')
+             if part not in ('', '.', '..')]
+    name = unique = '_'.join(parts) or 'output'
+    with _names_lock:
+        count = 1
+        while unique in args.names:
+            count += 1
+            unique = '%s-%d' % (name, count)
+        args.names.add(unique)
+    return unique
+
+def _write_frame(path, image, video_format, format):
+    data = image.get_data('RGB', video_format.width * 3)
+    f = open(path, 'wb')
+    try:
+        if format == 'ppm':
+            f.write('P6\n%d %d\n255\n' % (video_format.width,
+                                          video_format.height))
+        f.write(data)
+    finally:
+        f.close()
+
+def frames(filename, args):
+    '''Write the selected frames of a file to one image file each.'''
+    kwargs = {'skip_audio': True, 'keyframes_only': args.keyframes}
+    if args.stream is not None:
+        kwargs['streams'] = [args.stream]
+    source = AVbinSource(filename, **kwargs)
+    video_format = source.video_format
+    if not video_format:
+        raise MediaException('"%s" has no video stream' % filename)
+
+    name = _output_name(filename, args)
+    next_sample = args.start or 0.
+    if args.start:
+        source.seek(args.start)
+
+    count = 0
+    while True:
+        timestamp = source.get_next_video_timestamp()
+        if timestamp is None or (args.end is not None and
+                                 timestamp >= args.end):
+            return
+        if timestamp < next_sample:
+            source.skip_video_frame()
+            yield None
+            continue
+
+        image = source.get_next_video_frame()
+        path = os.path.join(args.output,
+                            '%s-%06d.%s' % (name, count, args.format))
+        _write_frame(path, image, video_format, args.format)
+        yield {'file': filename, 'timestamp': timestamp, 'path': path}
+        count += 1
+        if args.fps:
+            next_sample = timestamp + 1. / args.fps
+
+def _audio_target(native_format, args):
+    '''Return the format to write audio in, or None to keep it as is.'''
+    sample_format = args.sample_format
+    if (sample_format is None and args.format == 'wav' and
+            native_format.sample_format == SAMPLE_FORMAT_FLOAT):
+        # WAV files written by the wave module only hold integer samples
+        sample_format = SAMPLE_FORMAT_S16
+    if sample_format is None and args.channels is None and args.rate is None:
+        return None
+    return convert.make_format(args.channels or native_format.channels,
+                               sample_format or native_format.sample_format,
+                               args.rate or native_format.sample_rate)
+
+def audio(filename, args):
+    '''Write the audio of a file to a raw PCM or WAV file.'''
+    kwargs = {'skip_video': True}
+    if args.stream is not None:
+        kwargs['streams'] = [args.stream]
+    source = AVbinSource(filename, **kwargs)
+    if not source.audio_format:
+        raise MediaException('"%s" has no audio stream' % filename)
+
+    audio_format = source.audio_format
+    converter = None
+    target = _audio_target(audio_format, args)
+    if target is not None:
+        converter = convert.AudioConverter(audio_format, target)
+        audio_format = target
+    if args.format == 'wav' and audio_format.sample_format == \
+            SAMPLE_FORMAT_FLOAT:
+        raise MediaException('WAV output needs integer samples')
+
+    name = _output_name(filename, args)
+    path = os.path.join(args.output, '%s.%s' % (name, args.format))
+    if args.format == 'wav':
+        f = wave.open(path, 'wb')
+        f.setnchannels(audio_format.channels)
+        f.setsampwidth(audio_format.sample_size >> 3)
+        f.setframerate(audio_format.sample_rate)
+        write = f.writeframes
+    else:
+        f = open(path, 'wb')
+        write = f.write
+
+    length = 0
+    try:
+        for frame in source.extract(args.start or 0., args.end):
+            for audio_data in frame.audio:
+                if converter:
+                    audio_data = converter.convert(audio_data)
+                    if audio_data is None:
+                        continue
+                write(audio_data.get_string_data())
+                length += audio_data.length
+            yield None
+        if converter:
+            audio_data = converter.flush()
+            if audio_data is not None:
+                write(audio_data.get_string_data())
+                length += audio_data.length
+    finally:
+        f.close()
+
+    result = _describe(source.audio_streams[0], audio_format)
+    del result['type']
+    result.update({
+        'file': filename,
+        'path': path,
+        'duration': length / float(audio_format.bytes_per_second),
+    })
+    yield result
+
+def bench(filename, args):
+    '''Decode a whole file and report how fast it was decoded.'''
+    source = AVbinSource(filename, skip_video=args.no_video,
+                         skip_audio=args.no_audio)
+    started = time.time()
+    frames = 0
+    audio_duration = 0.
+    for frame in source.iter_av():
+        if frame.image is not None:
+            frames += 1
+        for audio_data in frame.audio:
+            audio_duration += audio_data.duration
+        yield None
+
+    seconds = max(time.time() - started, 1e-9)
+    yield {
+        'file': filename,
+        'duration': source.duration,
+        'frames': frames,
+        'audio_duration': audio_duration,
+        'seconds': seconds,
+        'fps': frames / seconds,
+        'speed': source.duration / seconds,
+    }
+
+def _run(command, filename, args):
+    '''Run `command` on a file, turning errors into records so that one
+    broken file does not stop the others.'''
+    try:
+        for record in command(filename, args):
+            yield record
+    except (MediaException, EnvironmentError), e:
+        yield {'file': filename, 'error': str(e)}
+
+def _summarize(results, errors, started, cpu_started):
+    '''Return the total throughput of a benchmark over all files.'''
+    wall = max(time.time() - started, 1e-9)
+    cpu = sum(os.times()[:2]) - cpu_started
+    frames = sum(record['frames'] for record in results)
+    duration = sum(record['duration'] for record in results)
+    return {'total': {
+        'files': len(results),
+        'errors': errors,
+        'frames': frames,
+        'duration': duration,
+        'seconds': wall,
+        'cpu_seconds': cpu,
+        'fps': frames / wall,
+        'speed': duration / wall,
+    }}
+
+def _add_files(parser):
+    parser.add_argument('files', nargs='+', metavar='FILE',
+                        help='media files, or - to read names from stdin')
+    parser.add_argument('-j', '--jobs', type=int, default=1,
+                        help='number of files decoded in parallel')
+
+def _add_range(parser):
+    parser.add_argument('--start', type=float,
+                        help='start time, in seconds')
+    parser.add_argument('--end', type=float,
+                        help='end time, in seconds')
+    parser.add_argument('--stream', type=int,
+                        help='index of the stream to decode')
+    parser.add_argument('-o', '--output', default='.',
+                        help='directory to write files to')
+
+def _make_parser():
+    parser = argparse.ArgumentParser(prog='python -m pyvideo',
+                                     description=__doc__.split('\n')[0])
+    commands = parser.add_subparsers(dest='command')
+
+    parser_probe = commands.add_parser('probe', help='print metadata')
+    _add_files(parser_probe)
+    parser_probe.set_defaults(function=probe)
+
+    parser_frames = commands.add_parser('frames', help='extract frames')
+    _add_files(parser_frames)
+    _add_range(parser_frames)
+    parser_frames.add_argument('--fps', type=float,
+                               help='frames extracted per second')
+    parser_frames.add_argument('--keyframes', action='store_true',
+                               help='only extract keyframes')
+    parser_frames.add_argument('--format', choices=('ppm', 'rgb'),
+                               default='ppm',
+                               help='PPM images or raw RGB data')
+    parser_frames.set_defaults(function=frames)
+
+    parser_audio = commands.add_parser('audio', help='extract audio')
+    _add_files(parser_audio)
+    _add_range(parser_audio)
+    parser_audio.add_argument('--format', choices=('wav', 'pcm'),
+                              default='wav',
+                              help='WAV file or raw interleaved samples')
+    parser_audio.add_argument('--rate', type=int,
+                              help='sample rate to resample to')
+    parser_audio.add_argument('--channels', type=int,
+                              help='number of channels to remix to')
+    parser_audio.add_argument('--sample-format',
+                              choices=(SAMPLE_FORMAT_U8, SAMPLE_FORMAT_S16,
+                                       SAMPLE_FORMAT_S24, SAMPLE_FORMAT_S32,
+                                       SAMPLE_FORMAT_FLOAT),
+                              help='sample format to convert to')
+    parser_audio.set_defaults(function=audio)
+
+    parser_bench = commands.add_parser('bench',
+                                       help='measure decoding speed')
+    _add_files(parser_bench)
+    parser_bench.add_argument('--no-video', action='store_true',
+                              help='do not decode video')
+    parser_bench.add_argument('--no-audio', action='store_true',
+                              help='do not decode audio')
+    parser_bench.set_defaults(function=bench)
+    return parser
+
+def _iter_filenames(files):
+    '''Iterate over the file names given on the command line, reading
+    names from stdin one line at a time for ``-``.'''
+    for filename in files:
+        if filename != '-':
+            yield filename
+            continue
+        for line in iter(sys.stdin.readline, ''):
+            line = line.strip()
+            if line:
+                yield line
+
+def main(argv=None):
+    args = _make_parser().parse_args(argv)
+    args.names = set()
+    if getattr(args, 'output', None) and not os.path.isdir(args.output):
+        os.makedirs(args.output)
+
+    started = time.time()
+    cpu_started = sum(os.times()[:2])
+
+    # Commands yield None while decoding, so that files interleave on the
+    # engine; records are written from this thread only.
+    records = Queue.Queue()
+    def collect(record):
+        if record is not None:
+            records.put(record)
+
+    # Files are submitted as their names arrive, so decoding starts while
+    # e.g. find is still walking a directory tree.
+    engine = DecodeEngine(workers=max(args.jobs, 1))
+    jobs = []
+    stopped = threading.Event()
+    def feed():
+        try:
+            for filename in _iter_filenames(args.files):
+                if stopped.is_set():
+                    break
+                jobs.append(engine.submit(
+                    _run(args.function, filename, args), collect))
+        finally:
+            engine.close()
+            records.put(_END)
+    feeder = threading.Thread(target=feed)
+    feeder.daemon = True
+    feeder.start()
+
+    results = []
+    errors = 0
+    try:
+        while True:
+            record = records.get()
+            if record is _END:
+                break
+            if 'error' in record:
+                errors += 1
+            elif args.command == 'bench':
+                results.append(record)
+            sys.stdout.write(json.dumps(record, sort_keys=True) + '\n')
+            sys.stdout.flush()
+        if args.command == 'bench':
+            sys.stdout.write(json.dumps(
+                _summarize(results, errors, started, cpu_started),
+                sort_keys=True) + '\n')
+            sys.stdout.flush()
+    except IOError:
+        # Output closed, e.g. piped into head
+        stopped.set()
+        for job in list(jobs):
+            job.cancel()
+        return 1
+
+    for job in jobs:
+        job.wait()
+    return 1 if errors else 0
+
+if __name__ == '__main__':
+    sys.exit(main())
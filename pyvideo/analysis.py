@@ -0,0 +1,209 @@
+'''Analysis stages working on decoded video frames.
+
+All analysis runs on downsampled luma with numpy, which needs to be
+installed to use this module.
+'''
+import lib
+from avbin import AVbinSource
+
+__author__ = 'Jernej Virag'
+
+#: Number of frames decoded at once by the analysis stages.
+BATCH_SIZE = 16
+
+#: Number of bins of the luma histograms compared between frames.
+HISTOGRAM_BINS = 32
+
+class ShotBoundary(object):
+    '''The start of a new shot.
+
+    :Ivariables:
+        `timestamp` : float
+            Timestamp of the first frame of the new shot, in seconds.
+        `score` : float
+            Difference between the frame and the one before it, from 0 to 1.
+
+    '''
+    __slots__ = ('timestamp', 'score')
+
+    def __init__(self, timestamp, score):
+        self.timestamp = timestamp
+        self.score = score
+
+    def __repr__(self):
+        return '%s(timestamp=%f, score=%f)' % (
+            self.__class__.__name__, self.timestamp, self.score)
+
+def _open(source, **kwargs):
+    if isinstance(source, AVbinSource):
+        return source
+    return AVbinSource(source, skip_audio=True, **kwargs)
+
+def iter_luma(source, size=64, start=None, end=None):
+    '''Iterate over downsampled luma planes of the frames of a source.
+
+    Frames are decoded in batches into a single reused buffer, so memory
+    use does not depend on the length of the file.
+
+    :Parameters:
+        `source` : `AVbinSource` or str
+            Source or file name to analyse.  Files are opened without audio.
+        `size` : int
+            Approximate width of the luma planes, in pixels.
+        `start` : float
+            Seek to this timestamp first.
+        `end` : float
+            Stop at the first frame with a timestamp past `end`.
+
+    :rtype: iterator of (float, numpy.ndarray)
+    '''
+    numpy = lib.load_numpy()
+    source = _open(source)
+    video_format = source.video_format
+    if not video_format:
+        return
+
+    width = video_format.width
+    height = video_format.height
+    step = max(1, width // size)
+    weights = numpy.array([77, 150, 29], numpy.uint16)
+
+    if start is not None:
+        source.seek(start)
+
+    out = numpy.empty((BATCH_SIZE, height, width, 3), numpy.uint8)
+    interval = previous = None
+    while True:
+        n = BATCH_SIZE
+        if end is not None:
+            # Only decode the frames left before `end`, estimated from the
+            # frame interval seen so far
+            timestamp = source.get_next_video_timestamp()
+            if timestamp is None or timestamp > end:
+                return
+            n = 1
+            if interval:
+                n = max(1, min(BATCH_SIZE,
+                               int((end - timestamp) / interval) + 1))
+
+        out, timestamps = source.read_batch(n, out)
+        if not timestamps:
+            return
+        frames = out[:len(timestamps), ::step, ::step]
+        luma = numpy.dot(frames, weights) >> 8
+        for i, timestamp in enumerate(timestamps):
+            if end is not None and timestamp > end:
+                return
+            yield timestamp, luma[i]
+
+        if len(timestamps) > 1:
+            interval = (timestamps[-1] - timestamps[0]) / (len(timestamps) - 1)
+        elif previous is not None:
+            interval = timestamps[0] - previous
+        previous = timestamps[-1]
+
+def iter_frame_metrics(source, size=64, start=None, end=None):
+    '''Iterate over the differences between consecutive frames.
+
+    Each item holds the timestamp of a frame, the mean absolute luma
+    difference to the frame before it and the distance between their luma
+    histograms, both scaled to the range 0 to 1.  The first frame is
+    compared against itself.
+
+    Parameters are the same as for `iter_luma`.
+
+    :rtype: iterator of (float, float, float)
+    '''
+    numpy = lib.load_numpy()
+    previous = previous_histogram = None
+    for timestamp, luma in iter_luma(source, size, start, end):
+        histogram = numpy.bincount(
+            (luma * HISTOGRAM_BINS >> 8).ravel(),
+            minlength=HISTOGRAM_BINS) / float(luma.size)
+        if previous is None:
+            previous, previous_histogram = luma, histogram
+
+        difference = numpy.abs(luma.astype(numpy.int16) - previous).mean()
+        distance = numpy.abs(histogram - previous_histogram).sum() / 2
+        yield timestamp, difference / 255., float(distance)
+        previous, previous_histogram = luma, histogram
+
+def _score(difference, distance):
+    return (difference + distance) / 2
+
+def _find_boundaries(metrics, threshold, min_shot_length, after=None):
+    boundaries = []
+    last = after
+    for timestamp, difference, distance in metrics:
+        score = _score(difference, distance)
+        if score < threshold:
+            continue
+        if last is not None and timestamp - last < min_shot_length:
+            # Keep the stronger of two cuts too close to each other
+            if boundaries and boundaries[-1].timestamp == last and \
+                    score > boundaries[-1].score:
+                boundaries[-1] = ShotBoundary(timestamp, score)
+                last = timestamp
+            continue
+        boundaries.append(ShotBoundary(timestamp, score))
+        last = timestamp
+    return boundaries
+
+def detect_shots(source, threshold=0.3, coarse=False, min_shot_length=0.5,
+                 size=64):
+    '''Find shot boundaries by comparing consecutive frames.
+
+    Frames are scored by the average of their mean absolute luma difference
+    and luma histogram distance to the frame before them; frames scoring
+    at least `threshold` start a new shot.
+
+    With `coarse`, only keyframes are decoded in a first pass.  Frames
+    between two keyframes are only decoded when the keyframes themselves
+    differ by at least `threshold`, and after the last keyframe, so most
+    of the file is never fully decoded.  Cuts that do not change the
+    picture enough between keyframes may be missed.
+
+    :Parameters:
+        `source` : `AVbinSource` or str
+            Source or file name to analyse.  A coarse pass needs a file
+            name, or a source opened with ``keyframes_only``.
+        `threshold` : float
+            Minimum score of a shot boundary, from 0 to 1.
+        `coarse` : bool
+            Decode keyframes first and refine only around candidate cuts.
+        `min_shot_length` : float
+            Minimum time between two boundaries, in seconds.
+        `size` : int
+            Approximate width of the analysed luma planes, in pixels.
+
+    :rtype: list of `ShotBoundary`
+    '''
+    if not coarse:
+        return _find_boundaries(iter_frame_metrics(source, size),
+                                threshold, min_shot_length)
+
+    if isinstance(source, AVbinSource):
+        keyframes, filename = source, source.filename
+    else:
+        keyframes, filename = _open(source, keyframes_only=True), source
+
+    candidates = []
+    previous = None
+    for timestamp, difference, distance in iter_frame_metrics(keyframes,
+                                                              size):
+        if previous is not None and \
+                _score(difference, distance) >= threshold:
+            candidates.append((previous, timestamp))
+        previous = timestamp
+    if previous is not None:
+        # Cuts after the last keyframe have no keyframe to compare against
+        candidates.append((previous, None))
+
+    source = _open(filename)
+    boundaries = []
+    for start, end in candidates:
+        after = boundaries[-1].timestamp if boundaries else None
+        boundaries.extend(_find_boundaries(
+            iter_frame_metrics(source, size, start, end),
+            threshold, min_shot_length, after))
+    return boundaries
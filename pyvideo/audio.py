@@ -2,6 +2,19 @@ import ctypes
 
 __author__ = 'Jernej Virag'
 
+SAMPLE_FORMAT_U8 = 'u8'
+SAMPLE_FORMAT_S16 = 's16'
+SAMPLE_FORMAT_S24 = 's24'
+SAMPLE_FORMAT_S32 = 's32'
+SAMPLE_FORMAT_FLOAT = 'float'
+
+_default_sample_formats = {
+    8: SAMPLE_FORMAT_U8,
+    16: SAMPLE_FORMAT_S16,
+    24: SAMPLE_FORMAT_S24,
+    32: SAMPLE_FORMAT_S32,
+}
+
 class AudioFormat(object):
     '''Audio details.
 
@@ -11,19 +24,27 @@ class AudioFormat(object):
 
     :Ivariables:
         `channels` : int
-            The number of channels: 1 for mono or 2 for stereo (pyglet does
-            not yet support surround-sound sources).
+            The number of channels: 1 for mono, 2 for stereo, 6 for 5.1
+            surround etc.  Samples of all channels are interleaved.
         `sample_size` : int
-            Bits per sample; only 8 or 16 are supported.
+            Bits per sample: 8, 16, 24 or 32.
         `sample_rate` : int
             Samples per second (in Hertz).
+        `sample_format` : str
+            Encoding of a single sample, one of the ``SAMPLE_FORMAT_*``
+            constants.  Samples are unsigned for 8 bits, signed little
+            endian integers or 32 bit floats otherwise.  Defaults to the
+            integer format matching `sample_size`.
 
     '''
 
-    def __init__(self, channels, sample_size, sample_rate):
+    def __init__(self, channels, sample_size, sample_rate, sample_format=None):
         self.channels = channels
         self.sample_size = sample_size
         self.sample_rate = sample_rate
+        if sample_format is None:
+            sample_format = _default_sample_formats[sample_size]
+        self.sample_format = sample_format
 
         # Convenience
         self.bytes_per_sample = (sample_size >> 3) * channels
@@ -32,15 +53,17 @@ class AudioFormat(object):
     def __eq__(self, other):
         return (self.channels == other.channels and
                 self.sample_size == other.sample_size and
-                self.sample_rate == other.sample_rate)
+                self.sample_rate == other.sample_rate and
+                self.sample_format == other.sample_format)
 
     def __ne__(self, other):
         return not self.__eq__(other)
 
     def __repr__(self):
-        return '%s(channels=%d, sample_size=%d, sample_rate=%d)' % (
+        return '%s(channels=%d, sample_size=%d, sample_rate=%d, ' \
+            'sample_format=%r)' % (
             self.__class__.__name__, self.channels, self.sample_size,
-            self.sample_rate)
+            self.sample_rate, self.sample_format)
 
 class AudioData(object):
     '''A single packet of audio data.
@@ -48,7 +71,7 @@ class AudioData(object):
     This class is used internally by pyglet.
 
     :Ivariables:
-        `data` : str or ctypes array or pointer
+        `data` : str, memoryview or ctypes array or pointer
             Sample data.
         `length` : int
             Size of sample data, in bytes.
@@ -75,7 +98,7 @@ class AudioData(object):
         elif bytes == 0:
             return
 
-        if not isinstance(self.data, str):
+        if not isinstance(self.data, (str, memoryview)):
             # XXX Create a string buffer for the whole packet then
             #     chop it up.  Could do some pointer arith here and
             #     save a bit of data pushing, but my guess is this is
@@ -88,10 +111,41 @@ class AudioData(object):
         self.duration -= bytes / float(audio_format.bytes_per_second)
         self.timestamp += bytes / float(audio_format.bytes_per_second)
 
+    def split(self, timestamp, audio_format):
+        '''Split the packet on the sample boundary closest to `timestamp`.
+
+        Sample data is not copied; both halves are views on this packet's
+        data.
+
+        :rtype: (AudioData, AudioData)
+        :return: Packets holding the samples before and from `timestamp`.
+            Either one is None if it would be empty.
+        '''
+        bytes_per_sample = audio_format.bytes_per_sample
+        samples = int(round((timestamp - self.timestamp) *
+                            audio_format.sample_rate))
+        bytes = min(max(samples * bytes_per_sample, 0), self.length)
+        if bytes == 0:
+            return None, self
+        elif bytes == self.length:
+            return self, None
+
+        data = self.data
+        if not isinstance(data, (str, memoryview)):
+            data = self.get_string_data()
+        data = memoryview(data)
+        duration = bytes / float(audio_format.bytes_per_second)
+        head = AudioData(data[:bytes], bytes, self.timestamp, duration)
+        tail = AudioData(data[bytes:], self.length - bytes,
+                         self.timestamp + duration, self.duration - duration)
+        return head, tail
+
     def get_string_data(self):
         '''Return data as a string.'''
         if type(self.data) is str:
             return self.data
+        elif isinstance(self.data, memoryview):
+            return self.data.tobytes()
 
         buf = ctypes.create_string_buffer(self.length)
         ctypes.memmove(buf, self.data, self.length)
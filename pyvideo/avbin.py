@@ -40,13 +40,20 @@
 '''Use avbin to decode audio and video media.
 '''
 from audio import AudioFormat, AudioData
+from audio import SAMPLE_FORMAT_U8, SAMPLE_FORMAT_S16, SAMPLE_FORMAT_S24, \
+    SAMPLE_FORMAT_S32, SAMPLE_FORMAT_FLOAT
+from buffers import PacketArena
 from exceptions import MediaFormatException
+from memory import governor, POLICY_DROP
 from video import VideoFormat, ImageData
 
 __docformat__ = 'restructuredtext'
 __version__ = '$Id: avbin.py 2090 Jernej Virag $'
 
 import ctypes
+import functools
+import threading
+
 import lib
 
 av = lib.load_avbin()
@@ -67,6 +74,14 @@ AVBIN_SAMPLE_FORMAT_S32 = 3
 AVBIN_SAMPLE_FORMAT_FLOAT = 4
 AVbinSampleFormat = ctypes.c_int
 
+_sample_formats = {
+    AVBIN_SAMPLE_FORMAT_U8: SAMPLE_FORMAT_U8,
+    AVBIN_SAMPLE_FORMAT_S16: SAMPLE_FORMAT_S16,
+    AVBIN_SAMPLE_FORMAT_S24: SAMPLE_FORMAT_S24,
+    AVBIN_SAMPLE_FORMAT_S32: SAMPLE_FORMAT_S32,
+    AVBIN_SAMPLE_FORMAT_FLOAT: SAMPLE_FORMAT_FLOAT,
+}
+
 AVBIN_LOG_QUIET = -8
 AVBIN_LOG_PANIC = 0
 AVBIN_LOG_FATAL = 8
@@ -192,126 +207,360 @@ def timestamp_to_avbin(timestamp):
     return int(timestamp * 1000000)
 
 class BufferedPacket(object):
-    def __init__(self, packet):
+    '''A packet read ahead of its stream, with its payload in an arena.'''
+    __slots__ = ('timestamp', 'stream_index', 'size', 'is_keyframe',
+                 '_arena', '_slab', '_offset')
+
+    def __init__(self, packet, arena):
         self.timestamp = packet.timestamp
         self.stream_index = packet.stream_index
-        self.data = (ctypes.c_uint8 * packet.size)()
         self.size = packet.size
-        ctypes.memmove(self.data, packet.data, self.size)
+        self.is_keyframe = packet.is_keyframe
+        self._arena = arena
+        self._slab, self._offset = arena.store(packet.data, packet.size)
+
+    def _get_data(self):
+        return ctypes.c_void_p(self._slab.address + self._offset)
+
+    data = property(_get_data)
+
+    def release(self):
+        '''Return the payload to the arena; `data` is invalid afterwards.'''
+        if self._slab is not None:
+            self._arena.release(self._slab, self.size)
+            self._slab = None
 
 class BufferedImage(object):
+    __slots__ = ('image', 'timestamp')
+
     def __init__(self, image, timestamp):
         self.image = image
         self.timestamp = timestamp
 
+# Opening and closing codecs is not thread safe in ffmpeg
+_codec_lock = threading.Lock()
+
+def _synchronized(func):
+    '''Run a method of `AVbinSource` with the lock of the source held.'''
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return func(self, *args, **kwargs)
+    return wrapper
+
+class AVFrame(object):
+    '''A video frame together with the audio played while it is shown.
+
+    :Ivariables:
+        `timestamp` : float
+            Presentation time of the frame, in seconds.
+        `end` : float
+            Presentation time of the following frame, or None for the last
+            frame of the stream.
+        `image` : ImageData
+            The decoded frame.
+        `audio` : tuple of AudioData
+            Audio packets covering ``[timestamp, end)``, split at sample
+            granularity.  The packets are views on the decoded audio, not
+            copies.
+
+    The attributes of a frame cannot be reassigned, and the source never
+    writes to the image and audio it returned, so a frame can be handed to
+    another thread.  The `ImageData` and `AudioData` objects themselves are
+    not frozen, though: `ImageData.set_data` and `AudioData.consume` change
+    them in place, so threads sharing a frame must not call them.
+    '''
+    __slots__ = ('timestamp', 'end', 'image', 'audio')
+
+    def __init__(self, timestamp, end, image, audio):
+        set = super(AVFrame, self).__setattr__
+        set('timestamp', timestamp)
+        set('end', end)
+        set('image', image)
+        set('audio', tuple(audio))
+
+    def __setattr__(self, name, value):
+        raise AttributeError('AVFrame is immutable')
+
+class _VideoStreamState(object):
+    '''Decoding state of a single video stream.'''
+    __slots__ = ('index', 'stream', 'format', 'frame_size', 'queue',
+                 'deferred', 'limited', 'shed', 'scratch', 'last_timestamp')
+
+    def __init__(self, index, stream, format):
+        self.index = index
+        self.stream = stream
+        self.format = format
+        self.frame_size = format.width * format.height * 3
+        # Decoded BufferedImages and deferred BufferedPackets, in order
+        self.queue = []
+        self.deferred = 0
+        # Frames kept compressed because of the memory limit
+        self.limited = 0
+        self.shed = 0
+        self.scratch = None
+        self.last_timestamp = None
+
+class _AudioStreamState(object):
+    '''Decoding state of a single audio stream.'''
+    __slots__ = ('index', 'stream', 'native_format', 'format', 'converter',
+                 'buffer', 'packet', 'packet_ptr', 'packet_size',
+                 'packet_timestamp', 'pending')
+
+    def __init__(self, index, stream, native_format, buffer):
+        self.index = index
+        self.stream = stream
+        self.native_format = native_format
+        self.format = native_format
+        self.converter = None
+        self.buffer = buffer
+        self.packet = None
+        self.packet_ptr = None
+        self.packet_size = 0
+        self.packet_timestamp = 0
+        # Audio left over by _read_audio_until
+        self.pending = None
+
 class AVbinSource(object):
+    '''A media file decoded with AVbin.
+
+    All streams are demuxed in a single pass; packets read while looking
+    for one stream are queued for the others, so streams that are decoded
+    but never read keep their packets in memory.  By default only the first
+    video and the first audio stream are decoded.  Pass ``streams='all'``
+    or a list of stream indices to decode others, then select them with
+    the `stream` argument of the read methods.  The first decoded stream of
+    each type stays the default.
+
+    With both ``skip_video`` and ``keyframes_only`` the video methods only
+    return the timestamps of keyframes, without decoding anything.
+
+    Sources are thread safe: every read holds a per-source lock, and the
+    images and audio returned are never touched by the source again.
+    AVbin releases the GIL while decoding, so different sources decode in
+    parallel on multiple threads, see `pyvideo.engine`.  Iterators, such as
+    the ones returned by `iter_av`, should only be consumed by one thread
+    at a time, as each of their steps is a separate read.
+    '''
     audio_format = None
+    native_audio_format = None
     video_format = None
 
-    def __init__(self, filename, file=None, skip_video=False, keyframes_only=False):
+    def __init__(self, filename, file=None, skip_video=False, keyframes_only=False,
+                 skip_audio=False, audio_output=None, streams=None):
         if file is not None:
             raise NotImplementedError('TODO: Load from file stream')
 
-        self._file = av.avbin_open_filename(filename)
+        with _codec_lock:
+            self._file = av.avbin_open_filename(filename)
         if not self._file:
             raise AVbinException('Could not open "%s"' % filename)
 
-        self._video_stream = None
-        self._audio_stream = None
+        self.filename = filename
+        self._lock = threading.RLock()
+
+        self._video = None
+        self._audio = None
+        self._video_streams = {}
+        self._audio_streams = {}
+        self.stream_formats = {}
         self._skip_video = skip_video
         self._keyframes_only = keyframes_only
+        self._preroll = None
+        self._cutoff = None
+
+        self._memory = governor.register(self)
+        self._arena = PacketArena(account=self._memory)
+        self._buffered_packets = {}
+        self._dropped_packets = 0
 
         file_info = AVbinFileInfo()
         file_info.structure_size = ctypes.sizeof(file_info)
         av.avbin_file_info(self._file, ctypes.byref(file_info))
         self._duration = timestamp_from_avbin(file_info.duration)
 
-        # Pick the first video and audio streams found, ignore others.
+        # Unless streams are selected, pick the first video and audio
+        # streams found and ignore others.
         for i in range(file_info.n_streams):
             info = AVbinStreamInfo()
             info.structure_size = ctypes.sizeof(info)
             av.avbin_stream_info(self._file, i, ctypes.byref(info))
 
-            if (info.type == AVBIN_STREAM_TYPE_VIDEO and
-                not self._video_stream):
+            if streams == 'all':
+                selected = True
+            elif streams is not None:
+                selected = i in streams
+            elif info.type == AVBIN_STREAM_TYPE_VIDEO:
+                selected = not self._video
+            else:
+                selected = not self._audio
+            if not selected:
+                continue
 
-                stream = av.avbin_open_stream(self._file, i)
+            if info.type == AVBIN_STREAM_TYPE_VIDEO:
+                with _codec_lock:
+                    stream = av.avbin_open_stream(self._file, i)
                 if not stream:
                     continue
 
-                self.video_format = VideoFormat(width=info.u.video.width,height=info.u.video.height)
+                video_format = VideoFormat(width=info.u.video.width,height=info.u.video.height)
                 if info.u.video.sample_aspect_num != 0:
-                    self.video_format.sample_aspect = (
+                    video_format.sample_aspect = (
                         float(info.u.video.sample_aspect_num) /
                             info.u.video.sample_aspect_den)
-                self._video_stream = stream
-                self._video_stream_index = i
+
+                state = _VideoStreamState(i, stream, video_format)
+                self._video_streams[i] = state
+                self.stream_formats[i] = video_format
+                if not self._video:
+                    self._video = state
+                    self.video_format = video_format
 
             elif (info.type == AVBIN_STREAM_TYPE_AUDIO and
-                  info.u.audio.sample_bits in (8, 16) and
-                  info.u.audio.channels in (1, 2) and
-                  not self._audio_stream):
+                  not skip_audio and
+                  info.u.audio.sample_format in _sample_formats and
+                  info.u.audio.channels > 0):
 
-                stream = av.avbin_open_stream(self._file, i)
+                with _codec_lock:
+                    stream = av.avbin_open_stream(self._file, i)
                 if not stream:
                     continue
 
-                self.audio_format = AudioFormat(
+                native_audio_format = AudioFormat(
                     channels=info.u.audio.channels,
                     sample_size=info.u.audio.sample_bits,
-                    sample_rate=info.u.audio.sample_rate)
-                self._audio_stream = stream
-                self._audio_stream_index = i
+                    sample_rate=info.u.audio.sample_rate,
+                    sample_format=_sample_formats[info.u.audio.sample_format])
+                buffer = (ctypes.c_uint8 * av.avbin_get_audio_buffer_size())()
+                self._memory.charge(len(buffer))
+
+                state = _AudioStreamState(i, stream, native_audio_format,
+                                          buffer)
+                if audio_output is not None:
+                    import convert
+                    state.converter = convert.AudioConverter(
+                        native_audio_format, audio_output)
+                    state.format = audio_output
+
+                self._audio_streams[i] = state
+                self._buffered_packets[i] = []
+                self.stream_formats[i] = state.format
+                if not self._audio:
+                    self._audio = state
+                    self.audio_format = state.format
+                    self.native_audio_format = native_audio_format
 
         self._packet = AVbinPacket()
         self._packet.structure_size = ctypes.sizeof(self._packet)
         self._packet.stream_index = -1
-        self._buffered_packets = []
-
-        self._buffer_streams = []
-        self._buffered_images = []
-        if self.audio_format:
-            self._audio_packet_ptr = 0
-            self._audio_packet_size = 0
-            self._audio_packet_timestamp = 0
-            self._audio_buffer = \
-                (ctypes.c_uint8 * av.avbin_get_audio_buffer_size())()
-            self._buffer_streams.append(self._audio_stream_index)
-
-        if self.video_format:
-            self._buffer_streams.append(self._video_stream_index)
-            self._force_next_video_image = True
-            self._last_video_timestamp = None
 
     def __del__(self):
         try:
-            if self._video_stream:
-                av.avbin_close_stream(self._video_stream)
-            if self._audio_stream:
-                av.avbin_close_stream(self._audio_stream)
-            av.avbin_close_file(self._file)
+            self._memory.close()
+        except:
+            pass
+
+        try:
+            with _codec_lock:
+                for state in self._video_streams.values():
+                    av.avbin_close_stream(state.stream)
+                for state in self._audio_streams.values():
+                    av.avbin_close_stream(state.stream)
+                av.avbin_close_file(self._file)
         except:
             pass
 
+    @_synchronized
     def seek(self, timestamp):
         av.avbin_seek_file(self._file, timestamp_to_avbin(timestamp))
-        self._buffered_packets = []
-        self._buffered_images = []
-        self._audio_packet_size = 0
-        self._force_next_video_image = True
-        self._last_video_timestamp = None
+        for packets in self._buffered_packets.values():
+            for packet in packets:
+                packet.release()
+            del packets[:]
+        for state in self._audio_streams.values():
+            self._release_audio_packet(state)
+            state.pending = None
+            if state.converter:
+                state.converter.reset()
+        for state in self._video_streams.values():
+            self._clear_images(state)
+            state.last_timestamp = None
 
     def _get_duration(self):
         return self._duration
 
     duration = property(lambda self: self._get_duration())
 
+    video_streams = property(lambda self: sorted(self._video_streams),
+        doc='''Indices of the decoded video streams.
+
+        The first one is the default stream of the video methods and the
+        one described by `video_format`.  `stream_formats` maps every
+        decoded stream index to its format.
+
+        :type: list of int
+        ''')
+
+    audio_streams = property(lambda self: sorted(self._audio_streams),
+        doc='''Indices of the decoded audio streams.
+
+        The first one is the default stream of the audio methods and the
+        one described by `audio_format`.
+
+        :type: list of int
+        ''')
+
+    def _get_video_state(self, stream):
+        if stream is None:
+            return self._video
+        try:
+            return self._video_streams[stream]
+        except KeyError:
+            raise AVbinException('Stream %r is not a decoded video stream' %
+                                 stream)
+
+    def _get_audio_state(self, stream):
+        if stream is None:
+            return self._audio
+        try:
+            return self._audio_streams[stream]
+        except KeyError:
+            raise AVbinException('Stream %r is not a decoded audio stream' %
+                                 stream)
+
+    @_synchronized
+    def get_stats(self):
+        '''Return a dictionary of buffering statistics for this source.
+
+        The ``memory`` entry is the number of bytes this source has charged
+        to the process wide `MemoryGovernor`, the ``arena`` entry describes
+        the memory used by packets read ahead of their stream, see
+        `PacketArena.get_stats`.  ``deferred_frames`` counts frames kept
+        compressed and ``shed_frames`` frames discarded because of the
+        memory limit, ``dropped_packets`` counts audio packets
+        discarded under `POLICY_DROP`.  Counts are totals over all streams.
+        '''
+        video_streams = self._video_streams.values()
+        stats = {
+            'buffered_packets': sum(len(packets) for packets in
+                                    self._buffered_packets.values()),
+            'buffered_images': sum(len(state.queue)
+                                   for state in video_streams),
+            'memory': self._memory.used,
+            'arena': self._arena.get_stats(),
+            'dropped_packets': self._dropped_packets,
+        }
+        if video_streams:
+            stats['deferred_frames'] = sum(state.limited
+                                           for state in video_streams)
+            stats['shed_frames'] = sum(state.shed for state in video_streams)
+        return stats
+
     def _get_packet_for_stream(self, stream_index):
         # See if a packet has already been buffered
-        for packet in self._buffered_packets:
-            if packet.stream_index == stream_index:
-                self._buffered_packets.remove(packet)
-                return packet
+        packets = self._buffered_packets.get(stream_index)
+        if packets:
+            return packets.pop(0)
 
         # XXX This is ugly and needs tuning per-codec.  Replace with an
         # explicit API for disabling unused streams (e.g. for silent driver).
@@ -327,141 +576,478 @@ class AVbinSource(object):
         while True:
             if av.avbin_read(self._file, self._packet) != AVBIN_RESULT_OK:
                 return None
-            elif self._packet.stream_index == stream_index:
+
+            index = self._packet.stream_index
+            if index == stream_index:
                 return self._packet
-            elif self._packet.stream_index == self._video_stream_index:
-                buffered_image = self._decode_video_packet(self._packet)
-                if buffered_image:
-                    self._buffered_images.append(buffered_image)
-            elif self._packet.stream_index in self._buffer_streams:
-                self._buffered_packets.append(BufferedPacket(self._packet))
-
-    def get_audio_data(self):
+            elif index in self._video_streams:
+                self._queue_video_packet(self._video_streams[index],
+                                         self._packet)
+            elif index in self._buffered_packets:
+                if self._packet_over_limit():
+                    self._dropped_packets += 1
+                    continue
+                self._buffered_packets[index].append(
+                    BufferedPacket(self._packet, self._arena))
+
+    def _packet_over_limit(self):
+        '''Return True if a packet read ahead of its stream has to be
+        dropped to stay under the memory limit.'''
+        if self._memory.policy != POLICY_DROP:
+            return False
+        size = self._arena.allocation_size(self._packet.size)
+        return size > 0 and self._memory.over_limit(size)
+
+    @_synchronized
+    def get_audio_data(self, stream=None):
+        state = self._get_audio_state(stream)
+        if not state:
+            return None
+
         while True:
-            while self._audio_packet_size > 0:
-                size_out = ctypes.c_int(len(self._audio_buffer))
+            while state.packet_size > 0:
+                size_out = ctypes.c_int(len(state.buffer))
 
-                used = av.avbin_decode_audio(self._audio_stream,
-                    self._audio_packet_ptr, self._audio_packet_size,
-                    self._audio_buffer, size_out)
+                used = av.avbin_decode_audio(state.stream,
+                    state.packet_ptr, state.packet_size,
+                    state.buffer, size_out)
 
                 if used < 0:
-                    self._audio_packet_size = 0
+                    state.packet_size = 0
                     break
 
-                self._audio_packet_ptr.value += used
-                self._audio_packet_size -= used
+                state.packet_ptr.value += used
+                state.packet_size -= used
 
                 if size_out.value <= 0:
                     continue
 
-                buffer = ctypes.string_at(self._audio_buffer, size_out)
-                duration = \
-                    float(len(buffer)) / self.audio_format.bytes_per_second
-                timestamp = self._audio_packet_timestamp
-                self._audio_packet_timestamp += duration
-                return AudioData(buffer, len(buffer), timestamp, duration)
+                duration = float(size_out.value) / \
+                    state.native_format.bytes_per_second
+                timestamp = state.packet_timestamp
+                state.packet_timestamp += duration
+                if (self._preroll is not None and
+                        timestamp + duration <= self._preroll):
+                    continue
+
+                buffer = ctypes.string_at(state.buffer, size_out)
+                audio_data = AudioData(buffer, len(buffer), timestamp, duration)
+                if state.converter:
+                    audio_data = state.converter.convert(audio_data)
+                    if audio_data is None:
+                        continue
+                return audio_data
 
-            packet = self._get_packet_for_stream(self._audio_stream_index)
+            self._release_audio_packet(state)
+            packet = self._get_packet_for_stream(state.index)
             if not packet:
+                if state.converter:
+                    return state.converter.flush()
                 return None
 
-            self._audio_packet_timestamp = \
-                timestamp_from_avbin(packet.timestamp)
-            self._audio_packet = packet # keep from GC
-            self._audio_packet_ptr = ctypes.cast(packet.data,
-                                                 ctypes.c_void_p)
-            self._audio_packet_size = packet.size
+            state.packet_timestamp = timestamp_from_avbin(packet.timestamp)
+            state.packet = packet # keep from GC
+            state.packet_ptr = ctypes.cast(packet.data, ctypes.c_void_p)
+            state.packet_size = packet.size
+
+    def iter_av(self):
+        '''Iterate over video frames paired with their audio.
+
+        Each frame is yielded as an `AVFrame` carrying exactly the audio
+        samples that play until the next frame is displayed.  Audio that
+        precedes the first frame is delivered with the first frame and
+        the last frame receives all remaining audio.  Sources without a
+        video track yield one `AVFrame` without an image per audio packet.
+        Only the default video and audio streams are used.
+
+        :rtype: iterator of `AVFrame`
+        '''
+        return self._iter_av(None, None)
+
+    def extract(self, start, end):
+        '''Iterate over the frames and audio in ``[start, end)``.
+
+        Frames are yielded as by `iter_av`, with the audio trimmed to the
+        requested range at sample granularity.  Frames and audio between
+        the keyframe preceding `start` and `start` itself are decoded but
+        never converted into images or audio packets, and demuxing stops
+        once every stream has passed `end`.
+
+        The source is left at an unspecified position afterwards; `seek`
+        before reading from it again.
+
+        :rtype: iterator of `AVFrame`
+        '''
+        self.seek(start)
+        self._preroll = start
+        self._cutoff = end
+        try:
+            for frame in self._iter_av(start, end):
+                yield frame
+        finally:
+            self._preroll = None
+            self._cutoff = None
+
+    def _iter_av(self, start, end):
+        if not self.video_format:
+            while self.audio_format:
+                audio = self._read_audio_until(None, start, end)
+                if not audio:
+                    return
+                audio = audio[0]
+                yield AVFrame(audio.timestamp,
+                              audio.timestamp + audio.duration, None, [audio])
+            return
+
+        if self._audio:
+            self._audio.pending = None
+        timestamp = self.get_next_video_timestamp()
+        while timestamp is not None and (end is None or timestamp < end):
+            image = self.get_next_video_frame()
+            if image is None and not self._skip_video:
+                return
+            timestamp = self._video.last_timestamp
+            next_timestamp = self.get_next_video_timestamp()
+            if end is not None and (next_timestamp is None or
+                                    next_timestamp > end):
+                next_timestamp = end
+
+            audio = []
+            if self.audio_format:
+                audio = self._read_audio_until(next_timestamp, start, end)
+
+            yield AVFrame(timestamp, next_timestamp, image, audio)
+            timestamp = next_timestamp
+
+    def _read_audio_until(self, timestamp, start, end):
+        '''Return the audio packets preceding `timestamp`, or all remaining
+        packets if it is None.  Samples outside ``[start, end)`` are
+        trimmed.  With no `timestamp`, `start` or `end` only one packet is
+        returned.'''
+        state = self._audio
+        audio = []
+        while True:
+            pending = state.pending
+            if pending is None:
+                pending = self.get_audio_data()
+                if pending is None:
+                    break
+            if start is not None:
+                _, pending = pending.split(start, state.format)
+                if pending is None:
+                    state.pending = None
+                    continue
+            if end is not None:
+                pending = pending.split(end, state.format)[0]
+                if pending is None:
+                    state.pending = None
+                    break
+
+            if timestamp is None:
+                head, state.pending = pending, None
+            else:
+                head, state.pending = pending.split(timestamp, state.format)
+            if head is not None:
+                audio.append(head)
+            if state.pending is not None or not self.video_format:
+                break
+        return audio
+
+    def detect_shots(self, threshold=0.3, coarse=False, **kwargs):
+        '''Find the shot boundaries in this file.
 
-    def _decode_video_packet(self, packet):
+        See `pyvideo.analysis.detect_shots`; the file is reopened for the
+        analysis, so the position of this source is not affected.
+
+        :rtype: list of `ShotBoundary`
+        '''
+        import analysis
+        return analysis.detect_shots(self.filename, threshold, coarse,
+                                     **kwargs)
+
+    def _release_audio_packet(self, state):
+        if isinstance(state.packet, BufferedPacket):
+            state.packet.release()
+        state.packet = None
+        state.packet_size = 0
+
+    def _decode_video_packet(self, state, packet):
         timestamp = timestamp_from_avbin(packet.timestamp)
+        if self._keyframes_only and packet.is_keyframe != 1:
+            return None
+
         if self._skip_video:
             return BufferedImage(None, timestamp)
 
-        if self._keyframes_only and packet.is_keyframe != 1:
+        if self._preroll is not None and timestamp < self._preroll:
+            # Keep the decoder state, but don't materialize the frame
+            self._decode_video_packet_into(state, packet,
+                                           self._get_scratch_frame(state))
             return None
 
-        width = self.video_format.width
-        height = self.video_format.height
+        width = state.format.width
+        height = state.format.height
         pitch = width * 3
         buffer = (ctypes.c_uint8 * (pitch * height))()
-        result = av.avbin_decode_video(self._video_stream,
-                                       packet.data, packet.size,
-                                       buffer)
-        if result < 0:
+        if not self._decode_video_packet_into(state, packet, buffer):
             return None
 
         return BufferedImage(ImageData(width, height, 'RGB', buffer, pitch), timestamp)
 
-    def _next_image(self):
+    def _decode_video_packet_into(self, state, packet, buffer):
+        result = av.avbin_decode_video(state.stream,
+                                       packet.data, packet.size,
+                                       buffer)
+        return result >= 0
+
+    def _decode_next_video_frame_into(self, state, buffer):
+        '''Decode the next video frame into `buffer`, returning its
+        timestamp, or None at the end of the stream.
+
+        Frames that were already decoded while reading ahead are copied
+        into `buffer`; all others are decoded straight into it.
+        '''
+        while state.queue:
+            img = state.queue.pop(0)
+            if isinstance(img, BufferedPacket):
+                state.deferred -= 1
+                decoded = self._decode_video_packet_into(state, img, buffer)
+                img.release()
+                if decoded:
+                    return timestamp_from_avbin(img.timestamp)
+                continue
+
+            if img.image:
+                self._memory.release(state.frame_size)
+                ctypes.memmove(buffer, img.image.get_data('RGB', img.image.pitch),
+                               state.frame_size)
+            return img.timestamp
+
+        while True:
+            packet = self._get_packet_for_stream(state.index)
+            if not packet:
+                return None
+            timestamp = timestamp_from_avbin(packet.timestamp)
+            if self._keyframes_only and packet.is_keyframe != 1:
+                continue
+            if self._skip_video:
+                return timestamp
+            if self._decode_video_packet_into(state, packet, buffer):
+                return timestamp
+
+    def _get_scratch_frame(self, state):
+        if state.scratch is None:
+            state.scratch = (ctypes.c_uint8 * state.frame_size)()
+            self._memory.charge(state.frame_size)
+        return state.scratch
+
+    def _queue_video_packet(self, state, packet):
+        '''Buffer a video packet read while looking for another stream.
+
+        Frames are normally decoded right away.  Once the memory limit is
+        reached they are kept compressed in the packet arena instead, and
+        so is every frame after them or after a frame queued compressed by
+        `get_next_video_timestamp`, as frames must be decoded in order.
+        '''
+        if (self._cutoff is not None and
+                timestamp_from_avbin(packet.timestamp) >= self._cutoff):
+            return
+        over_limit = not self._skip_video and self._frame_over_limit(state)
+        if over_limit or (state.deferred and not self._skip_video):
+            if self._keyframes_only and packet.is_keyframe != 1:
+                return
+            state.queue.append(BufferedPacket(packet, self._arena))
+            state.deferred += 1
+            if over_limit:
+                state.limited += 1
+            return
+
+        img = self._decode_video_packet(state, packet)
+        if img:
+            if img.image:
+                self._memory.charge(state.frame_size)
+            state.queue.append(img)
+
+    def _frame_over_limit(self, state):
+        if not self._memory.over_limit(state.frame_size):
+            return False
+        elif self._memory.policy != POLICY_DROP:
+            return True
+
+        # Shed the oldest decoded frames until the new one fits
+        for img in list(state.queue):
+            if not self._memory.over_limit(state.frame_size):
+                break
+            if isinstance(img, BufferedImage) and img.image:
+                state.queue.remove(img)
+                self._memory.release(state.frame_size)
+                state.shed += 1
+        return False
+
+    def _clear_images(self, state):
+        '''Discard all buffered frames without decoding deferred ones.'''
+        for img in state.queue:
+            if isinstance(img, BufferedPacket):
+                img.release()
+            elif img.image:
+                self._memory.release(state.frame_size)
+        del state.queue[:]
+        state.deferred = 0
+
+    def _pop_image(self, state):
+        '''Remove the next frame from the buffered frames, decoding it if
+        it was deferred.  Returns None if no frames are buffered.'''
+        while state.queue:
+            img = state.queue.pop(0)
+            if isinstance(img, BufferedPacket):
+                state.deferred -= 1
+                packet, img = img, self._decode_video_packet(state, img)
+                packet.release()
+                if not img:
+                    continue
+            elif img.image:
+                self._memory.release(state.frame_size)
+            return img
+
+    def _next_image(self, state):
         img = None
         while not img:
-            packet = self._get_packet_for_stream(self._video_stream_index)
+            packet = self._get_packet_for_stream(state.index)
             if not packet:
                 return
-            img = self._decode_video_packet(packet)
+            img = self._decode_video_packet(state, packet)
 
         return img
 
-    def get_next_video_timestamp(self):
-        if not self.video_format:
+    @_synchronized
+    def get_next_video_timestamp(self, stream=None):
+        state = self._get_video_state(stream)
+        if not state:
             return
 
-        try:
-            img = self._buffered_images[0]
-        except IndexError:
-            img = self._next_image()
-            self._buffered_images.append(img)
-
-        if img:
+        if state.queue:
+            img = state.queue[0]
+            if isinstance(img, BufferedPacket):
+                return timestamp_from_avbin(img.timestamp)
             return img.timestamp
 
-    def get_next_video_frame(self):
-        if not self.video_format:
+        # Queue the next packet without decoding it, so callers can decide
+        # whether they need the frame at all.
+        while True:
+            packet = self._get_packet_for_stream(state.index)
+            if not packet:
+                return None
+            timestamp = timestamp_from_avbin(packet.timestamp)
+            if self._keyframes_only and packet.is_keyframe != 1:
+                continue
+            elif self._skip_video:
+                state.queue.append(BufferedImage(None, timestamp))
+                return timestamp
+            elif self._preroll is not None and timestamp < self._preroll:
+                self._decode_video_packet_into(state, packet,
+                                               self._get_scratch_frame(state))
+                continue
+
+            state.queue.append(BufferedPacket(packet, self._arena))
+            state.deferred += 1
+            return timestamp
+
+    @_synchronized
+    def get_next_video_frame(self, stream=None):
+        state = self._get_video_state(stream)
+        if not state:
             return
 
-        try:
-            img = self._buffered_images.pop(0)
-        except IndexError:
-            img = self._next_image()
-
+        img = self._pop_image(state) or self._next_image(state)
         if img:
-            self._last_video_timestamp = img.timestamp
-            self._force_next_video_image = False
+            state.last_timestamp = img.timestamp
             return img.image
 
-    def _update_texture(self, player, timestamp):
-        if not self.video_format:
-            return
+    @_synchronized
+    def skip_video_frame(self, stream=None):
+        '''Discard the next video frame without converting it to an image.
 
-        if self._last_video_timestamp > timestamp:
-            return
+        The frame is still decoded if needed to keep the decoder state
+        intact, but into a scratch buffer that is reused.
 
-        img = None
-        i = 0
-        while (not img or
-                (img.timestamp < timestamp and
-                 not self._force_next_video_image) ):
-            if self._buffered_images:
-                img = self._buffered_images.pop(0)
-            else:
-                packet = self._get_packet_for_stream(self._video_stream_index)
-                if not packet:
-                    return
-                img = self._decode_video_packet(packet)
+        :rtype: float
+        :return: Timestamp of the discarded frame, or None at the end of
+            the stream.
+        '''
+        state = self._get_video_state(stream)
+        if not state:
+            return
 
-            # Emergency loop exit when timestamps are bad
-            i += 1
-            if i > 60:
+        return self._decode_next_video_frame_into(
+            state, self._get_scratch_frame(state))
+
+    @_synchronized
+    def read_batch(self, n, out=None, step=1, stream=None):
+        '''Decode up to `n` video frames into one contiguous buffer.
+
+        Frames are stored back to back as RGB, so the buffer can be viewed
+        as an ``(n, height, width, 3)`` array of unsigned bytes, e.g. with
+        ``numpy.frombuffer(out, numpy.uint8).reshape(n, height, width, 3)``.
+        When the stream ends before `n` frames were decoded only the first
+        ``len(timestamps)`` frames of the buffer are valid.
+
+        :Parameters:
+            `n` : int
+                Number of frames in the batch.
+            `out` : writable buffer
+                Buffer of at least ``n * width * height * 3`` bytes to
+                decode into, e.g. the buffer returned by a previous call or
+                a numpy array.  A new ctypes array is allocated if omitted.
+            `step` : int
+                Only keep every `step`-th frame.  Skipped frames are still
+                decoded, but into a scratch buffer.
+            `stream` : int
+                Index of the video stream to decode, defaults to the first.
+
+        :rtype: (buffer, list of float)
+        :return: The output buffer and the timestamps of the decoded frames.
+        '''
+        state = self._get_video_state(stream)
+        if not state:
+            return out, []
+
+        frame_size = state.frame_size
+        if out is None:
+            out = (ctypes.c_uint8 * (n * frame_size))()
+        address = ctypes.addressof(
+            (ctypes.c_uint8 * (n * frame_size)).from_buffer(out))
+
+        if step > 1:
+            scratch = self._get_scratch_frame(state)
+
+        timestamps = []
+        while len(timestamps) < n:
+            timestamp = self._decode_next_video_frame_into(
+                state, address + len(timestamps) * frame_size)
+            if timestamp is None:
                 break
+            timestamps.append(timestamp)
+            state.last_timestamp = timestamp
 
-        if img:
-            player._texture.blit_into(img.image, 0, 0, 0)
-            self._last_video_timestamp = img.timestamp
-            self._force_next_video_image = False
+            for i in range(step - 1):
+                if self._decode_next_video_frame_into(state, scratch) is None:
+                    break
+
+        return out, timestamps
+
+    def iter_batches(self, n, out=None, step=1, stream=None):
+        '''Iterate over batches of frames decoded by `read_batch`.
+
+        The same output buffer is reused for every batch, so its contents
+        are only valid until the next batch is requested.
 
-    def _release_texture(self, player):
-        player._texture = None
+        :rtype: iterator of (buffer, list of float)
+        '''
+        while True:
+            out, timestamps = self.read_batch(n, out, step, stream)
+            if not timestamps:
+                return
+            yield out, timestamps
 
 if avbin_has_multithreading:
     try:
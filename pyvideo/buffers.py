@@ -0,0 +1,145 @@
+import ctypes
+
+__author__ = 'Jernej Virag'
+
+class _Slab(object):
+    '''A fixed-size block of memory packets are carved out of.
+
+    Allocations bump `used` forwards; the slab is only rewound once every
+    packet allocated from it has been released, so addresses handed out
+    stay valid for as long as the packet is alive.
+    '''
+    __slots__ = ('data', 'address', 'capacity', 'used', 'live')
+
+    def __init__(self, capacity):
+        self.data = (ctypes.c_uint8 * capacity)()
+        self.address = ctypes.addressof(self.data)
+        self.capacity = capacity
+        self.used = 0
+        self.live = 0
+
+class PacketArena(object):
+    '''Growable slab arena holding the payloads of buffered packets.
+
+    Packets read out of order are copied in here instead of into a fresh
+    ctypes array each, so a demuxer interleaving audio and video only
+    allocates when the arena has to grow.  Payloads are released in
+    roughly the order they were stored, so slabs drain and get reused in
+    ring fashion.  If a `MemoryAccount` is given, slab allocations are
+    charged to it.
+
+    :Ivariables:
+        `allocations` : int
+            Number of payloads stored since the arena was created.
+        `slab_allocations` : int
+            Number of slabs allocated from the system.
+
+    '''
+
+    #: Default size of a single slab, in bytes.
+    slab_size = 256 * 1024
+
+    #: Number of drained slabs kept around for reuse.
+    max_spare_slabs = 2
+
+    def __init__(self, slab_size=None, account=None):
+        if slab_size:
+            self.slab_size = slab_size
+        self._account = account
+
+        self._current = None
+        self._slabs = []
+        self._spare = []
+
+        self.allocations = 0
+        self.slab_allocations = 0
+        self._bytes_in_use = 0
+        self._live = 0
+
+    def store(self, data, size):
+        '''Copy `size` bytes from the `data` pointer into the arena.
+
+        :rtype: (`_Slab`, int)
+        :return: The slab holding the payload and its offset in the slab.
+        '''
+        slab = self._current
+        if slab is None or slab.capacity - slab.used < size:
+            if slab is not None and not slab.live:
+                self._retire(slab)
+            slab = self._current = self._get_slab(size)
+
+        offset = slab.used
+        ctypes.memmove(slab.address + offset, data, size)
+        slab.used += size
+        slab.live += 1
+
+        self.allocations += 1
+        self._bytes_in_use += size
+        self._live += 1
+        return slab, offset
+
+    def allocation_size(self, size):
+        '''Return the number of bytes storing a payload of `size` bytes
+        would newly allocate, 0 if it fits in memory the arena holds.'''
+        slab = self._current
+        if slab is not None and slab.capacity - slab.used >= size:
+            return 0
+        if size <= self.slab_size and self._spare:
+            return 0
+        return max(size, self.slab_size)
+
+    def release(self, slab, size):
+        '''Release a payload previously returned by `store`.'''
+        slab.live -= 1
+        self._bytes_in_use -= size
+        self._live -= 1
+        if slab.live:
+            return
+
+        slab.used = 0
+        if slab is not self._current:
+            self._retire(slab)
+
+    def _retire(self, slab):
+        self._slabs.remove(slab)
+        if (slab.capacity == self.slab_size and
+                len(self._spare) < self.max_spare_slabs):
+            self._spare.append(slab)
+        elif self._account:
+            self._account.release(slab.capacity)
+
+    def _get_slab(self, size):
+        if size <= self.slab_size and self._spare:
+            slab = self._spare.pop()
+        else:
+            slab = _Slab(max(size, self.slab_size))
+            self.slab_allocations += 1
+            if self._account:
+                self._account.charge(slab.capacity)
+        self._slabs.append(slab)
+        return slab
+
+    def _get_capacity(self):
+        return sum(slab.capacity for slab in self._slabs + self._spare)
+
+    capacity = property(lambda self: self._get_capacity(),
+        doc='''Total bytes currently allocated by the arena.
+
+        :type: int
+        ''')
+
+    bytes_in_use = property(lambda self: self._bytes_in_use,
+        doc='''Bytes held by live payloads.
+
+        :type: int
+        ''')
+
+    def get_stats(self):
+        '''Return a dictionary describing arena usage.'''
+        return {
+            'allocations': self.allocations,
+            'slab_allocations': self.slab_allocations,
+            'live_packets': self._live,
+            'bytes_in_use': self._bytes_in_use,
+            'capacity': self.capacity,
+        }
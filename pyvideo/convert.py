@@ -0,0 +1,208 @@
+'''Conversion of decoded audio between sample formats, channel layouts and
+sample rates.
+
+Conversion works on whole packets at once with numpy, which needs to be
+installed to use this module.
+'''
+import lib
+from audio import AudioData, AudioFormat
+from audio import SAMPLE_FORMAT_U8, SAMPLE_FORMAT_S16, SAMPLE_FORMAT_S24, \
+    SAMPLE_FORMAT_S32, SAMPLE_FORMAT_FLOAT
+from exceptions import MediaFormatException
+from resample import Resampler
+
+__author__ = 'Jernej Virag'
+
+_sample_sizes = {
+    SAMPLE_FORMAT_U8: 8,
+    SAMPLE_FORMAT_S16: 16,
+    SAMPLE_FORMAT_S24: 24,
+    SAMPLE_FORMAT_S32: 32,
+    SAMPLE_FORMAT_FLOAT: 32,
+}
+
+# Channel order of the surround layouts decoded by ffmpeg
+_FL, _FR, _FC, _LFE, _BL, _BR, _SL, _SR = range(8)
+_surround = {
+    6: (_FL, _FR, _FC, _LFE, _BL, _BR),
+    8: (_FL, _FR, _FC, _LFE, _BL, _BR, _SL, _SR),
+}
+_center_level = 0.7071
+
+def make_format(channels, sample_format, sample_rate):
+    '''Create an `AudioFormat` for `sample_format`, e.g. ``make_format(1,
+    SAMPLE_FORMAT_FLOAT, 16000)`` for float mono audio at 16kHz.'''
+    try:
+        sample_size = _sample_sizes[sample_format]
+    except KeyError:
+        raise MediaFormatException('Unknown sample format "%s"' %
+                                   sample_format)
+    return AudioFormat(channels, sample_size, sample_rate, sample_format)
+
+def _stereo_matrix(numpy, channels):
+    matrix = numpy.zeros((channels, 2), numpy.float32)
+    layout = _surround.get(channels)
+    if layout is None:
+        # Unknown layout, alternate channels between left and right
+        matrix[0::2, 0] = 1
+        matrix[1::2, 1] = 1
+    else:
+        for i, channel in enumerate(layout):
+            if channel in (_FL, _SL):
+                matrix[i, 0] = 1 if channel == _FL else _center_level
+            elif channel in (_FR, _SR):
+                matrix[i, 1] = 1 if channel == _FR else _center_level
+            elif channel == _FC:
+                matrix[i] = _center_level
+            elif channel == _BL:
+                matrix[i, 0] = _center_level
+            elif channel == _BR:
+                matrix[i, 1] = _center_level
+    return matrix / matrix.sum(axis=0)
+
+def mix_matrix(in_channels, out_channels):
+    '''Return the ``(in_channels, out_channels)`` matrix used to remix
+    samples, or None if no remixing is needed.
+
+    Mono is copied to every output channel.  Surround layouts are mixed
+    down to stereo with the centre and back channels at -3dB and the LFE
+    channel left out; mono output is the average of the stereo mix.  Other
+    layouts keep the channels they have in common.
+    '''
+    numpy = lib.load_numpy()
+    if in_channels == out_channels:
+        return None
+    elif in_channels == 1:
+        return numpy.ones((1, out_channels), numpy.float32)
+    elif out_channels <= 2:
+        matrix = _stereo_matrix(numpy, in_channels)
+        if out_channels == 1:
+            matrix = matrix.mean(axis=1).reshape(in_channels, 1)
+        return matrix
+
+    matrix = numpy.zeros((in_channels, out_channels), numpy.float32)
+    for i in range(min(in_channels, out_channels)):
+        matrix[i, i] = 1
+    return matrix
+
+def to_float(data, audio_format):
+    '''Decode interleaved sample data into a ``(samples, channels)`` array of
+    floats between -1 and 1.'''
+    numpy = lib.load_numpy()
+    sample_format = audio_format.sample_format
+    if sample_format == SAMPLE_FORMAT_FLOAT:
+        samples = numpy.frombuffer(data, '<f4')
+    elif sample_format == SAMPLE_FORMAT_U8:
+        samples = (numpy.frombuffer(data, numpy.uint8)
+                   .astype(numpy.float32) - 128) / 128
+    elif sample_format == SAMPLE_FORMAT_S16:
+        samples = numpy.frombuffer(data, '<i2').astype(numpy.float32) / 2**15
+    elif sample_format == SAMPLE_FORMAT_S24:
+        raw = numpy.frombuffer(data, numpy.uint8).reshape(-1, 3)
+        # Place the 3 bytes in the top of an int32 to keep the sign
+        padded = numpy.zeros((len(raw), 4), numpy.uint8)
+        padded[:, 1:] = raw
+        samples = padded.view('<i4').ravel().astype(numpy.float32) / 2**31
+    elif sample_format == SAMPLE_FORMAT_S32:
+        samples = numpy.frombuffer(data, '<i4').astype(numpy.float32) / 2**31
+    else:
+        raise MediaFormatException('Unknown sample format "%s"' %
+                                   sample_format)
+    return samples.reshape(-1, audio_format.channels)
+
+def from_float(samples, audio_format):
+    '''Encode a ``(samples, channels)`` array of floats into interleaved
+    sample data.'''
+    numpy = lib.load_numpy()
+    sample_format = audio_format.sample_format
+    if sample_format == SAMPLE_FORMAT_FLOAT:
+        return samples.astype('<f4').tostring()
+
+    samples = numpy.clip(samples, -1, 1)
+    if sample_format == SAMPLE_FORMAT_U8:
+        data = (samples * 127 + 128).round().astype(numpy.uint8)
+    elif sample_format == SAMPLE_FORMAT_S16:
+        data = (samples * (2**15 - 1)).round().astype('<i2')
+    elif sample_format == SAMPLE_FORMAT_S24:
+        data = (samples * (2**23 - 1)).round().astype('<i4')
+        data = data.view(numpy.uint8).reshape(-1, 4)[:, :3]
+    elif sample_format == SAMPLE_FORMAT_S32:
+        data = (samples.astype(numpy.float64) * (2**31 - 1)).round() \
+            .astype('<i4')
+    else:
+        raise MediaFormatException('Unknown sample format "%s"' %
+                                   sample_format)
+    return numpy.ascontiguousarray(data).tostring()
+
+class AudioConverter(object):
+    '''Converts audio packets to another sample format, channel layout and
+    sample rate.
+
+    Samples are converted through 32 bit floats a whole packet at a time.
+    When the sample rate changes, a `Resampler` keeps filter state between
+    packets, so `convert` may hold back samples and return None; call
+    `flush` at the end of the stream and `reset` after seeking.
+
+    :Ivariables:
+        `source_format` : AudioFormat
+            Format of the packets passed to `convert`.
+        `target_format` : AudioFormat
+            Format of the packets returned by `convert`.
+
+    '''
+
+    def __init__(self, source_format, target_format):
+        self.source_format = source_format
+        self.target_format = target_format
+        self._matrix = mix_matrix(source_format.channels,
+                                  target_format.channels)
+
+        self._resampler = None
+        if source_format.sample_rate != target_format.sample_rate:
+            self._resampler = Resampler(target_format.channels,
+                                        source_format.sample_rate,
+                                        target_format.sample_rate)
+
+    def convert(self, audio_data):
+        '''Return `audio_data` converted to the target format.
+
+        :rtype: `AudioData`
+        :return: The converted packet, or None if all samples were held back
+            by the resampler.
+        '''
+        if self.source_format == self.target_format:
+            return audio_data
+
+        samples = to_float(audio_data.get_string_data(), self.source_format)
+        if self._matrix is not None:
+            samples = samples.dot(self._matrix)
+
+        timestamp = audio_data.timestamp
+        if self._resampler:
+            samples, timestamp = self._resampler.process(samples, timestamp)
+            if not len(samples):
+                return None
+        return self._make_audio_data(samples, timestamp)
+
+    def flush(self):
+        '''Return the samples held back by the resampler, or None.
+
+        :rtype: `AudioData`
+        '''
+        if not self._resampler:
+            return None
+
+        samples, timestamp = self._resampler.flush()
+        if not len(samples):
+            return None
+        return self._make_audio_data(samples, timestamp)
+
+    def reset(self):
+        '''Drop the samples held back by the resampler.'''
+        if self._resampler:
+            self._resampler.reset()
+
+    def _make_audio_data(self, samples, timestamp):
+        data = from_float(samples, self.target_format)
+        duration = float(len(samples)) / self.target_format.sample_rate
+        return AudioData(data, len(data), timestamp, duration)
@@ -0,0 +1,237 @@
+'''A pool of threads decoding many sources concurrently.
+
+AVbin is called through ctypes, which releases the GIL for the duration of
+every call, so sources decoded on different threads run in parallel on
+multiple cores without the cost of sending frames between processes.
+'''
+import Queue
+import sys
+import threading
+
+from avbin import AVbinSource
+
+__author__ = 'Jernej Virag'
+
+#: Number of items a worker produces for a job before moving on to the next.
+QUANTUM = 8
+
+#: Number of items a job without a callback buffers ahead of its consumer.
+MAX_BUFFERED = 16
+
+_END = object()
+
+def _cpu_count():
+    try:
+        import multiprocessing
+        return multiprocessing.cpu_count()
+    except (ImportError, NotImplementedError):
+        return 1
+
+def _iter_file(filename, kwargs):
+    # Opened lazily, so the file is opened by a worker
+    source = AVbinSource(filename, **kwargs)
+    for frame in source.iter_av():
+        yield frame
+
+class DecodeJob(object):
+    '''The items produced by an iterator submitted to a `DecodeEngine`.
+
+    Unless the job has a callback, iterate over it to receive its items in
+    order.  Iteration blocks until items are available and re-raises the
+    exception that stopped the job, if any.  At most `max_buffered` items
+    are produced ahead of the consumer; a job with a full buffer is set
+    aside and only handed back to the pool once items are consumed, so
+    decoded frames do not pile up in memory.
+
+    :Ivariables:
+        `items` : int
+            Number of items produced so far.
+
+    '''
+
+    def __init__(self, iterator, callback=None, queue=None,
+                 max_buffered=MAX_BUFFERED):
+        self._iterator = iterator
+        self._callback = callback
+        self._queue = queue
+        self.max_buffered = max_buffered
+        self._results = Queue.Queue()
+        self._finished = threading.Event()
+        self._lock = threading.Lock()
+        self._parked = False
+        self._cancelled = False
+        self._error = None
+        self.items = 0
+
+    def _get_done(self):
+        return self._finished.is_set()
+
+    done = property(lambda self: self._get_done(),
+        doc='''True once the job is exhausted, failed or was cancelled.
+
+        :type: bool
+        ''')
+
+    def __iter__(self):
+        while True:
+            item = self._results.get()
+            if item is _END:
+                # Leave the marker for other consumers
+                self._results.put(_END)
+                self._raise_error()
+                return
+            self._resume()
+            yield item
+
+    def wait(self, timeout=None):
+        '''Wait for the job to finish.
+
+        :rtype: bool
+        :return: True if the job finished, False if `timeout` expired.
+        '''
+        if not self._finished.wait(timeout):
+            return False
+        self._raise_error()
+        return True
+
+    def cancel(self):
+        '''Stop the job the next time a worker gets to it.'''
+        self._cancelled = True
+        self._resume()
+
+    def _resume(self):
+        '''Hand a job set aside with a full buffer back to the pool.'''
+        with self._lock:
+            if not self._parked:
+                return
+            self._parked = False
+        self._queue.put(self)
+
+    def _raise_error(self):
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def _run(self, quantum):
+        '''Produce up to `quantum` items.  Returns True if the job should go
+        back in the queue, False if it finished or its buffer is full.'''
+        try:
+            for i in range(quantum):
+                if self._cancelled:
+                    break
+                if self._callback is None:
+                    with self._lock:
+                        if self._results.qsize() >= self.max_buffered:
+                            self._parked = True
+                            return False
+                item = next(self._iterator)
+                self.items += 1
+                if self._callback is None:
+                    self._results.put(item)
+                else:
+                    self._callback(item)
+            else:
+                return True
+        except StopIteration:
+            pass
+        except Exception:
+            self._error = sys.exc_info()
+
+        self._results.put(_END)
+        self._finished.set()
+        return False
+
+class DecodeEngine(object):
+    '''Decodes many sources concurrently on a pool of threads.
+
+    Jobs are served round-robin: a worker advances a job by `quantum`
+    items, then puts it at the back of the queue, so long files do not
+    starve short ones.  Each job is advanced by only one worker at a time,
+    so it is safe to submit iterators over sources that are not otherwise
+    shared between threads.
+
+    :Ivariables:
+        `quantum` : int
+            Number of items produced for a job per turn.
+        `max_buffered` : int
+            Number of items produced ahead of the consumer of a job without
+            a callback.
+        `workers` : int
+            Number of decoding threads.
+
+    '''
+
+    def __init__(self, workers=None, quantum=QUANTUM,
+                 max_buffered=MAX_BUFFERED):
+        if workers is None:
+            workers = _cpu_count()
+        self.workers = workers
+        self.quantum = quantum
+        self.max_buffered = max_buffered
+        self._queue = Queue.Queue()
+        self._jobs = []
+        self._threads = []
+        for i in range(workers):
+            thread = threading.Thread(target=self._work,
+                                      name='pyvideo-decode-%d' % i)
+            thread.daemon = True
+            thread.start()
+            self._threads.append(thread)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def submit(self, iterator, callback=None):
+        '''Decode the items of `iterator` on the pool.
+
+        :Parameters:
+            `iterator` : iterable
+                Items to produce, e.g. ``source.iter_batches(16)``.  It is
+                advanced from worker threads.
+            `callback` : callable
+                Called on a worker thread with every item.  If omitted,
+                items are delivered by iterating over the job.
+
+        :rtype: `DecodeJob`
+        '''
+        job = DecodeJob(iter(iterator), callback, self._queue,
+                        self.max_buffered)
+        self._jobs = [other for other in self._jobs if not other.done]
+        self._jobs.append(job)
+        self._queue.put(job)
+        return job
+
+    def decode_file(self, filename, callback=None, **kwargs):
+        '''Decode the frames of a file, as from `AVbinSource.iter_av`.
+
+        The file is opened by a worker with `kwargs` passed on to
+        `AVbinSource`.
+
+        :rtype: `DecodeJob`
+        '''
+        return self.submit(_iter_file(filename, kwargs), callback)
+
+    def close(self):
+        '''Wait for all submitted jobs to finish and stop the workers.
+
+        Jobs without a callback only finish once their items are consumed
+        or they are cancelled.
+        '''
+        for job in self._jobs:
+            job._finished.wait()
+        for thread in self._threads:
+            self._queue.put(None)
+        for thread in self._threads:
+            thread.join()
+        del self._threads[:]
+        del self._jobs[:]
+
+    def _work(self):
+        while True:
+            job = self._queue.get()
+            if job is None:
+                return
+            if job._run(self.quantum):
+                self._queue.put(job)
@@ -0,0 +1,243 @@
+'''Perceptual fingerprints for finding near-duplicate videos.
+
+A signature is built by sampling frames at a fixed rate, computing a 64 bit
+difference hash of each and merging the hashes into a fixed number of
+segments spread over the file, so that every file gets a signature of the
+same size no matter how long it is.  numpy needs to be installed to use
+this module.
+'''
+import bisect
+
+import lib
+from avbin import AVbinSource
+from exceptions import MediaException
+
+__author__ = 'Jernej Virag'
+
+#: Number of sampled frames hashed at once.
+BATCH_SIZE = 16
+
+#: Number of 64 bit hashes in a signature.
+SEGMENTS = 16
+
+#: Number of signatures compared at once by `SignatureIndex.search`.
+SEARCH_CHUNK = 65536
+
+def hash_frames(frames):
+    '''Compute 64 bit difference hashes of a batch of RGB frames.
+
+    Each frame is reduced to a 9x8 luma thumbnail by averaging; every bit
+    of the hash tells whether a thumbnail pixel is brighter than its left
+    neighbour, as in the common dHash implementations.  Bits are packed row
+    by row, most significant bit first.  Frames smaller than the thumbnail are enlarged first.
+
+    :Parameters:
+        `frames` : numpy.ndarray
+            Array of shape ``(n, height, width, 3)`` holding RGB frames.
+
+    :rtype: numpy.ndarray of uint64
+    '''
+    numpy = lib.load_numpy()
+    n, height, width = frames.shape[:3]
+    if height < 8 or width < 9:
+        frames = frames.repeat(-(-8 // height), axis=1) \
+            .repeat(-(-9 // width), axis=2)
+        n, height, width = frames.shape[:3]
+    luma = numpy.dot(frames, numpy.array([0.299, 0.587, 0.114],
+                                         numpy.float32))
+
+    rows = numpy.linspace(0, height, 9).astype(numpy.intp)[:-1]
+    columns = numpy.linspace(0, width, 10).astype(numpy.intp)[:-1]
+    thumbnails = numpy.add.reduceat(
+        numpy.add.reduceat(luma, rows, axis=1), columns, axis=2)
+    thumbnails /= numpy.outer(numpy.diff(numpy.append(rows, height)),
+                              numpy.diff(numpy.append(columns, width)))
+
+    bits = thumbnails[:, :, 1:] > thumbnails[:, :, :-1]
+    return numpy.packbits(bits.reshape(n, 64), axis=1).view('>u8') \
+        .astype(numpy.uint64).ravel()
+
+def _scan_keyframes(filename):
+    '''Return the timestamps of all keyframes, found without decoding.'''
+    source = AVbinSource(filename, skip_video=True, keyframes_only=True,
+                         skip_audio=True)
+    keyframes = []
+    while True:
+        timestamp = source.skip_video_frame()
+        if timestamp is None:
+            return keyframes
+        keyframes.append(timestamp)
+
+def _iter_sampled_frames(source, rate, keyframes):
+    '''Iterate over (timestamp, image) pairs sampled `rate` times per
+    second.  With `keyframes` the source must only decode keyframes.
+
+    Otherwise the first frame of every sampling interval is returned.
+    Frames are read forward, and the source only seeks when the next
+    sample lies past a keyframe that has not been reached yet, so no frame
+    is decoded twice.
+    '''
+    interval = 1. / rate
+    if keyframes:
+        next_sample = 0.
+        while True:
+            timestamp = source.get_next_video_timestamp()
+            if timestamp is None:
+                return
+            if timestamp < next_sample:
+                source.skip_video_frame()
+                continue
+            yield timestamp, source.get_next_video_frame()
+            next_sample = timestamp + interval
+        return
+
+    keyframe_timestamps = _scan_keyframes(source.filename)
+    position = None
+    sample = 0.
+    while sample < source.duration:
+        index = bisect.bisect_right(keyframe_timestamps, sample) - 1
+        if (position is not None and index >= 0 and
+                keyframe_timestamps[index] > position):
+            source.seek(sample)
+
+        timestamp = source.get_next_video_timestamp()
+        while timestamp is not None and timestamp < sample:
+            position = source.skip_video_frame()
+            timestamp = source.get_next_video_timestamp()
+        if timestamp is None:
+            return
+
+        if timestamp < sample + interval:
+            position = timestamp
+            yield timestamp, source.get_next_video_frame()
+        sample += interval
+
+def compute_signature(filename, rate=1.0, keyframes=False,
+                      segments=SEGMENTS):
+    '''Compute the fingerprint of a file.
+
+    :Parameters:
+        `filename` : str
+            File to fingerprint.
+        `rate` : float
+            Frames sampled per second.
+        `keyframes` : bool
+            Only sample keyframes, which is faster but depends on how the
+            file was encoded.  Otherwise frames are sampled by seeking.
+        `segments` : int
+            Number of 64 bit hashes in the signature.  Hashes of all frames
+            sampled in a segment are merged by majority vote per bit.
+
+    :rtype: numpy.ndarray of uint64
+    '''
+    numpy = lib.load_numpy()
+    source = AVbinSource(filename, keyframes_only=keyframes, skip_audio=True)
+    video_format = source.video_format
+    if not video_format:
+        raise MediaException('"%s" has no video stream' % filename)
+    duration = source.duration or 1.
+
+    votes = numpy.zeros((segments, 64), numpy.int32)
+    counts = numpy.zeros(segments, numpy.int32)
+    batch = numpy.empty((BATCH_SIZE, video_format.height,
+                         video_format.width, 3), numpy.uint8)
+    timestamps = []
+
+    def add_batch():
+        hashes = hash_frames(batch[:len(timestamps)])
+        bits = numpy.unpackbits(hashes.astype('>u8').view(numpy.uint8)
+                                .reshape(-1, 8), axis=1)
+        index = (numpy.array(timestamps) / duration * segments) \
+            .astype(numpy.intp).clip(0, segments - 1)
+        numpy.add.at(votes, index, bits)
+        numpy.add.at(counts, index, 1)
+        del timestamps[:]
+
+    for timestamp, image in _iter_sampled_frames(source, rate, keyframes):
+        data = image.get_data('RGB', video_format.width * 3)
+        batch[len(timestamps)] = numpy.frombuffer(data, numpy.uint8) \
+            .reshape(video_format.height, video_format.width, 3)
+        timestamps.append(timestamp)
+        if len(timestamps) == BATCH_SIZE:
+            add_batch()
+    if timestamps:
+        add_batch()
+
+    bits = votes * 2 > numpy.maximum(counts, 1)[:, None]
+    return numpy.packbits(bits, axis=1).view('>u8').astype(numpy.uint64) \
+        .ravel()
+
+def _popcount_table():
+    numpy = lib.load_numpy()
+    return numpy.unpackbits(numpy.arange(256, dtype=numpy.uint8)
+                            .reshape(-1, 1), axis=1).sum(axis=1) \
+        .astype(numpy.uint16)
+
+def hamming_distance(a, b):
+    '''Return the number of differing bits between two signatures.'''
+    numpy = lib.load_numpy()
+    a = numpy.atleast_1d(numpy.asarray(a, numpy.uint64))
+    xor = numpy.bitwise_xor(a, numpy.asarray(b, numpy.uint64))
+    return int(_popcount_table()[xor.view(numpy.uint8)].sum())
+
+class SignatureIndex(object):
+    '''An in-memory collection of signatures searchable by Hamming
+    distance.
+
+    Signatures are kept in one contiguous array and compared against a
+    query in chunks of `SEARCH_CHUNK` with vectorized bit counting, which
+    is fast enough for millions of signatures.
+    '''
+
+    def __init__(self, segments=SEGMENTS):
+        numpy = lib.load_numpy()
+        self.segments = segments
+        self.keys = []
+        self._signatures = numpy.empty((1024, segments), numpy.uint64)
+        self._popcount = _popcount_table()
+
+    def __len__(self):
+        return len(self.keys)
+
+    def add(self, key, signature):
+        '''Add the `signature` of a file identified by `key`.'''
+        numpy = lib.load_numpy()
+        if len(self.keys) == len(self._signatures):
+            self._signatures = numpy.concatenate(
+                (self._signatures, numpy.empty_like(self._signatures)))
+        self._signatures[len(self.keys)] = signature
+        self.keys.append(key)
+
+    def search(self, signature, max_distance=None, limit=10):
+        '''Find the signatures closest to `signature`.
+
+        :Parameters:
+            `signature` : numpy.ndarray
+                Signature to look for.
+            `max_distance` : int
+                Only return signatures differing in at most this many bits.
+            `limit` : int
+                Maximum number of results, or None for all of them.
+
+        :rtype: list of (key, int)
+        :return: Keys and distances of the matches, closest first.
+        '''
+        numpy = lib.load_numpy()
+        signature = numpy.asarray(signature, numpy.uint64)
+        count = len(self.keys)
+        distances = numpy.empty(count, numpy.uint32)
+        for start in range(0, count, SEARCH_CHUNK):
+            chunk = self._signatures[start:min(start + SEARCH_CHUNK, count)]
+            xor = numpy.bitwise_xor(chunk, signature)
+            distances[start:start + len(chunk)] = self._popcount[
+                xor.view(numpy.uint8)].sum(axis=1)
+
+        if max_distance is not None:
+            matches = numpy.nonzero(distances <= max_distance)[0]
+        else:
+            matches = numpy.arange(count)
+        if limit is not None and len(matches) > limit:
+            matches = matches[numpy.argpartition(distances[matches],
+                                                 limit - 1)[:limit]]
+        matches = matches[numpy.argsort(distances[matches], kind='mergesort')]
+        return [(self.keys[i], int(distances[i])) for i in matches]
@@ -2,6 +2,7 @@ __author__ = 'Jernej Virag'
 
 import os
 from ctypes import cdll, util
+from exceptions import MediaException
 
 def load_avbin():
     """
@@ -14,4 +15,16 @@ def load_avbin():
 		libname = util.find_library("avbin")
 		lib = cdll.LoadLibrary(libname)
 		
-    return lib
\ No newline at end of file
+    return lib
+
+def load_numpy():
+    """
+    Imports numpy, which is needed by the analysis features, and returns it
+    """
+
+    try:
+        import numpy
+    except ImportError:
+        raise MediaException("This feature requires numpy to be installed")
+
+    return numpy
@@ -0,0 +1,145 @@
+import threading
+import weakref
+
+__author__ = 'Jernej Virag'
+
+#: Keep decoding frames read ahead of their stream while over the limit,
+#: but store them compressed and decode them once they are requested.
+POLICY_DEFER = 'defer'
+
+#: Discard the oldest frames read ahead of their stream to get back under
+#: the limit, and audio packets read ahead that would need more memory.
+#: Discarded frames and packets are lost.
+POLICY_DROP = 'drop'
+
+class MemoryAccount(object):
+    '''Memory held by a single source.
+
+    Sources report every allocation they keep around (audio buffers,
+    buffered frames and packet arenas) to their account, which in turn
+    updates the process wide totals of its `MemoryGovernor`.
+
+    :Ivariables:
+        `used` : int
+            Bytes currently held by the source.
+
+    '''
+    __slots__ = ('_governor', '_owner', 'used', '__weakref__')
+
+    def __init__(self, governor, owner):
+        self._governor = governor
+        self._owner = weakref.ref(owner)
+        self.used = 0
+
+    def charge(self, bytes):
+        self._governor._update(self, bytes)
+
+    def release(self, bytes):
+        self._governor._update(self, -bytes)
+
+    def over_limit(self, bytes=0):
+        '''Return True if allocating `bytes` more would exceed the limit.'''
+        return self._governor.over_limit(bytes)
+
+    def _get_policy(self):
+        return self._governor.policy
+
+    policy = property(lambda self: self._get_policy())
+
+    def close(self):
+        '''Release everything charged to this account.'''
+        self._governor._update(self, -self.used)
+        self._governor._unregister(self)
+
+class MemoryGovernor(object):
+    '''Process wide accountant for memory held by decoding sources.
+
+    The limit is enforced on memory for data read ahead of its stream:
+    decoded frames under both policies, and packets under `POLICY_DROP`.
+    Under `POLICY_DEFER` compressed packets are always kept, as dropping
+    them would lose data, so a source whose streams are read unevenly can
+    still exceed the limit by the size of its packet arena.  Fixed
+    allocations such as audio decoding buffers are counted but never
+    refused.
+
+    :Ivariables:
+        `limit` : int
+            Ceiling for the memory held by all sources together, in bytes,
+            or None for no limit.
+        `policy` : str
+            What sources do when the limit is reached, either
+            `POLICY_DEFER` or `POLICY_DROP`.
+
+    '''
+
+    def __init__(self, limit=None, policy=POLICY_DEFER):
+        self.limit = limit
+        self.policy = policy
+        self._lock = threading.Lock()
+        self._accounts = set()
+        self._total = 0
+
+    def register(self, owner):
+        '''Open a new account for `owner`.
+
+        :rtype: `MemoryAccount`
+        '''
+        account = MemoryAccount(self, owner)
+        with self._lock:
+            self._accounts.add(account)
+        return account
+
+    def _unregister(self, account):
+        with self._lock:
+            self._accounts.discard(account)
+
+    def _update(self, account, bytes):
+        with self._lock:
+            account.used += bytes
+            self._total += bytes
+
+    def over_limit(self, bytes=0):
+        '''Return True if allocating `bytes` more would exceed the limit.'''
+        return self.limit is not None and self._total + bytes > self.limit
+
+    def _get_total(self):
+        return self._total
+
+    total = property(lambda self: self._get_total(),
+        doc='''Bytes held by all sources together.
+
+        :type: int
+        ''')
+
+    def get_usage(self):
+        '''Return a dictionary mapping each live source to the bytes it
+        holds.'''
+        with self._lock:
+            accounts = list(self._accounts)
+
+        usage = {}
+        for account in accounts:
+            owner = account._owner()
+            if owner is not None:
+                usage[owner] = account.used
+        return usage
+
+governor = MemoryGovernor()
+
+def set_memory_limit(limit, policy=None):
+    '''Set the ceiling for memory held by all sources in this process.
+
+    See `MemoryGovernor` for what the ceiling applies to under each policy.
+
+    :Parameters:
+        `limit` : int
+            Ceiling in bytes, or None to remove the limit.
+        `policy` : str
+            Either `POLICY_DEFER` or `POLICY_DROP`; unchanged if omitted.
+
+    '''
+    if policy is not None:
+        if policy not in (POLICY_DEFER, POLICY_DROP):
+            raise ValueError('Unknown memory policy "%s"' % policy)
+        governor.policy = policy
+    governor.limit = limit
@@ -0,0 +1,116 @@
+'''Streaming sample rate conversion of decoded audio.
+
+numpy needs to be installed to use this module.
+'''
+import math
+
+import lib
+
+__author__ = 'Jernej Virag'
+
+class Resampler(object):
+    '''Converts a continuous stream of samples to another sample rate.
+
+    Samples are interpolated with a Hann windowed sinc filter, evaluated for
+    all output samples of a chunk at once.  The filter is low-passed to the
+    lower of the two Nyquist frequencies.  Input samples still needed by
+    the filter are kept between chunks, so consecutive chunks are resampled
+    without seams.  Call `reset` when the input is discontinuous, e.g.
+    after seeking.
+
+    :Ivariables:
+        `channels` : int
+            Number of interleaved channels.
+        `in_rate` : int
+            Sample rate of the input, in Hertz.
+        `out_rate` : int
+            Sample rate of the output, in Hertz.
+
+    '''
+
+    def __init__(self, channels, in_rate, out_rate, taps=32):
+        numpy = lib.load_numpy()
+        self.channels = channels
+        self.in_rate = in_rate
+        self.out_rate = out_rate
+
+        self._step = float(in_rate) / out_rate
+        self._cutoff = min(1., float(out_rate) / in_rate)
+        # Half the filter length in input samples, wider when low-passing
+        self._half = int(math.ceil(taps / 2 / self._cutoff))
+        self._offsets = numpy.arange(-self._half + 1, self._half + 1)
+        self.reset()
+
+    def reset(self):
+        '''Forget all buffered samples and timing.'''
+        numpy = lib.load_numpy()
+        self._history = numpy.zeros((self._half - 1, self.channels),
+                                    numpy.float32)
+        self._position = float(self._half - 1)
+        self._timestamp = None
+        self._count = 0
+
+    def process(self, samples, timestamp):
+        '''Resample a chunk of input.
+
+        :Parameters:
+            `samples` : numpy.ndarray
+                Float array of shape ``(samples, channels)``.
+            `timestamp` : float
+                Time of the first input sample, in seconds.  Only used for
+                the first chunk after a reset; later chunks are assumed to
+                follow on.
+
+        :rtype: (numpy.ndarray, float)
+        :return: The resampled output, which may be empty, and the time of
+            its first sample.
+        '''
+        numpy = lib.load_numpy()
+        if self._timestamp is None:
+            self._timestamp = timestamp
+
+        buffer = numpy.concatenate((self._history, samples))
+        return self._resample(buffer, len(buffer) - self._half)
+
+    def flush(self):
+        '''Resample the input held back for the filter, as if the stream was
+        followed by silence, and reset.
+
+        :rtype: (numpy.ndarray, float)
+        '''
+        numpy = lib.load_numpy()
+        if self._timestamp is None:
+            return numpy.zeros((0, self.channels), numpy.float32), None
+
+        buffer = numpy.concatenate((self._history, numpy.zeros(
+            (self._half, self.channels), numpy.float32)))
+        result = self._resample(buffer, len(self._history))
+        self.reset()
+        return result
+
+    def _resample(self, buffer, limit):
+        '''Compute all output samples positioned before `limit` in
+        `buffer`.'''
+        numpy = lib.load_numpy()
+        count = int(math.ceil((limit - self._position) / self._step))
+        count = max(count, 0)
+
+        positions = self._position + numpy.arange(count) * self._step
+        base = numpy.floor(positions).astype(numpy.intp)
+        x = self._offsets - (positions - base)[:, None]
+        weights = numpy.sinc(x * self._cutoff) * \
+            (0.5 + 0.5 * numpy.cos(numpy.pi * x / self._half))
+        weights /= weights.sum(axis=1)[:, None]
+        window = buffer[base[:, None] + self._offsets]
+        output = numpy.einsum('ij,ijk->ik', weights, window) \
+            .astype(numpy.float32)
+
+        timestamp = self._timestamp + float(self._count) / self.out_rate
+        self._count += count
+
+        # Keep the samples still needed for the next output sample
+        self._position += count * self._step
+        drop = min(max(int(self._position) - self._half + 1, 0), len(buffer))
+        self._history = buffer[drop:]
+        self._position -= drop
+        return output, timestamp
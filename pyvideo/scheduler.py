@@ -0,0 +1,138 @@
+import time
+
+__author__ = 'Jernej Virag'
+
+class Clock(object):
+    '''A presentation clock following wall-clock time.
+
+    Calling the clock returns the current presentation time in seconds.  The
+    clock starts out paused at time 0.
+    '''
+
+    def __init__(self, time_function=time.time):
+        self._time_function = time_function
+        self._offset = 0.0
+        self._started = None
+
+    def start(self):
+        '''Start or resume the clock.'''
+        if self._started is None:
+            self._started = self._time_function()
+
+    def pause(self):
+        '''Stop the clock at the current time.'''
+        if self._started is not None:
+            self._offset += self._time_function() - self._started
+            self._started = None
+
+    def set(self, timestamp):
+        '''Set the current presentation time.'''
+        self._offset = timestamp
+        if self._started is not None:
+            self._started = self._time_function()
+
+    def _get_running(self):
+        return self._started is not None
+
+    running = property(lambda self: self._get_running())
+
+    def __call__(self):
+        if self._started is None:
+            return self._offset
+        return self._offset + self._time_function() - self._started
+
+class PresentationScheduler(object):
+    '''Decides which video frames of a source to present in real time.
+
+    Call `update` whenever a new frame could be shown.  Frames which are
+    already due are presented; frames that fell behind the clock by more
+    than `drop_threshold` are skipped without being converted to images,
+    so that presentation catches up with the clock when decoding is too
+    slow.
+
+    :Ivariables:
+        `clock` : callable
+            Returns the current presentation time in seconds.
+        `audio_clock` : callable
+            Returns the timestamp of the audio currently being heard, or None
+            if there is no audio output.  Used to measure A/V drift.
+        `late_threshold` : float
+            Frames presented more than this many seconds after their
+            timestamp are counted as late.
+        `drop_threshold` : float
+            Frames more than this many seconds behind the clock are dropped.
+
+    '''
+
+    def __init__(self, source, clock=None, audio_clock=None,
+                 late_threshold=0.02, drop_threshold=0.1):
+        if clock is None:
+            clock = Clock()
+            clock.start()
+
+        self.source = source
+        self.clock = clock
+        self.audio_clock = audio_clock
+        self.late_threshold = late_threshold
+        self.drop_threshold = drop_threshold
+
+        self.presented = 0
+        self.dropped = 0
+        self.late = 0
+        self.drift = 0.0
+        self.av_drift = None
+        self.timestamp = None
+
+    def update(self):
+        '''Return the frame to present at the current clock time.
+
+        :rtype: (float, ImageData)
+        :return: The timestamp and image of the frame to present, or None if
+            the frame presented last is still current.  The image is None
+            for sources opened with ``skip_video``.
+        '''
+        source = self.source
+        while True:
+            now = self.clock()
+            timestamp = source.get_next_video_timestamp()
+            if timestamp is None or timestamp > now:
+                return None
+
+            if now - timestamp > self.drop_threshold:
+                source.skip_video_frame()
+                self.dropped += 1
+                continue
+
+            image = source.get_next_video_frame()
+            self.presented += 1
+            self.timestamp = timestamp
+            self.drift = now - timestamp
+            if self.drift > self.late_threshold:
+                self.late += 1
+            if self.audio_clock is not None:
+                audio_timestamp = self.audio_clock()
+                if audio_timestamp is not None:
+                    self.av_drift = timestamp - audio_timestamp
+            return timestamp, image
+
+    def seek(self, timestamp):
+        '''Seek the source and move the clock to `timestamp`.'''
+        self.source.seek(timestamp)
+        if hasattr(self.clock, 'set'):
+            self.clock.set(timestamp)
+        self.timestamp = None
+
+    def get_stats(self):
+        '''Return a dictionary with presentation statistics.
+
+        ``drift`` is how far the last presented frame lagged behind the
+        clock and ``av_drift`` how far it was ahead of the audio being
+        heard, both in seconds.
+        '''
+        return {
+            'presented': self.presented,
+            'dropped': self.dropped,
+            'late': self.late,
+            'drift': self.drift,
+            'av_drift': self.av_drift,
+        }
@@ -1,6 +1,14 @@
+import json
+import subprocess
+import sys
+import threading
 import unittest
 from unittest.case import TestCase
 import pyvideo
+from pyvideo import convert, fingerprint
+from pyvideo.audio import SAMPLE_FORMAT_FLOAT
+from pyvideo.engine import DecodeEngine
+from pyvideo.scheduler import Clock, PresentationScheduler
 
 class DecodingComplianceTests(TestCase):
     def setUp(self):
@@ -33,6 +41,262 @@ class DecodingComplianceTests(TestCase):
                 if audio_data is None or audio_data.timestamp > timestamp:
                     break
 
+    def testBufferedPacketArena(self):
+        source = pyvideo.load("test_media/test_video.mp4")
+        # Reading only video buffers every audio packet in the arena
+        while source.get_next_video_frame() is not None:
+            pass
+        stats = source.get_stats()
+        self.assertGreater(stats['buffered_packets'], 0)
+        self.assertEqual(stats['arena']['live_packets'], stats['buffered_packets'])
+        self.assertLess(stats['arena']['slab_allocations'], stats['arena']['allocations'])
+
+        while source.get_audio_data() is not None:
+            pass
+        stats = source.get_stats()
+        self.assertEqual(stats['arena']['live_packets'], 0)
+        self.assertEqual(stats['arena']['bytes_in_use'], 0)
+
+    def testSynchronizedDecode(self):
+        source = pyvideo.load("test_media/test_video.mp4")
+        audio_format = source.audio_format
+        frames = 0
+        for frame in source.iter_av():
+            self.assertIsNotNone(frame.image)
+            frames += 1
+            for audio in frame.audio:
+                self.assertEqual(audio.length % audio_format.bytes_per_sample, 0)
+                if frame.end is not None:
+                    self.assertLess(audio.timestamp, frame.end)
+        self.assertGreater(frames, 0)
+
+    def testBatchDecode(self):
+        source = pyvideo.load("test_media/test_video.mp4")
+        video_format = source.video_format
+        frame_size = video_format.width * video_format.height * 3
+
+        out, timestamps = source.read_batch(16)
+        self.assertEqual(len(out), 16 * frame_size)
+        self.assertEqual(len(timestamps), 16)
+        self.assertEqual(timestamps, sorted(timestamps))
+
+        # The buffer is reused and the last batch may be partial
+        batches = list(source.iter_batches(16, out=out, step=2))
+        self.assertTrue(all(batch is out for batch, _ in batches))
+        self.assertLessEqual(len(batches[-1][1]), 16)
+
+    def testMemoryLimit(self):
+        reference = pyvideo.load("test_media/test_video.mp4")
+        while reference.get_audio_data() is not None:
+            pass
+        budget = reference.get_stats()['memory']
+        self.assertEqual(reference.get_stats()['deferred_frames'], 0)
+        frames = 0
+        while reference.get_next_video_frame() is not None:
+            frames += 1
+
+        pyvideo.set_memory_limit(1)
+        try:
+            source = pyvideo.load("test_media/test_video.mp4")
+            self.assertIn(source, pyvideo.memory.governor.get_usage())
+            # Reading all audio first defers every frame instead of decoding it
+            while source.get_audio_data() is not None:
+                pass
+            self.assertGreater(source.get_stats()['deferred_frames'], 0)
+            self.assertLess(source.get_stats()['memory'], budget)
+
+            decoded = 0
+            while source.get_next_video_frame() is not None:
+                decoded += 1
+            self.assertEqual(decoded, frames)
+
+            # Dropping audio read ahead keeps packets out of the arena
+            pyvideo.set_memory_limit(1, pyvideo.memory.POLICY_DROP)
+            source = pyvideo.load("test_media/test_video.mp4")
+            while source.get_next_video_frame() is not None:
+                pass
+            self.assertGreater(source.get_stats()['dropped_packets'], 0)
+            self.assertEqual(source.get_stats()['arena']['capacity'], 0)
+        finally:
+            pyvideo.set_memory_limit(None, pyvideo.memory.POLICY_DEFER)
+
+    def testExtract(self):
+        source = pyvideo.load("test_media/test_video.mp4")
+        audio_format = source.audio_format
+        frames = list(source.extract(2.0, 3.0))
+        self.assertGreater(len(frames), 0)
+        for frame in frames:
+            self.assertGreaterEqual(frame.timestamp, 2.0)
+            self.assertLess(frame.timestamp, 3.0)
+
+        audio = [packet for frame in frames for packet in frame.audio]
+        self.assertAlmostEqual(audio[0].timestamp, 2.0, places=3)
+        length = sum(packet.length for packet in audio)
+        self.assertAlmostEqual(length / float(audio_format.bytes_per_second),
+                               1.0, places=3)
+
+    def testPresentationScheduler(self):
+        now = [0.0]
+        clock = Clock(lambda: now[0])
+        clock.start()
+        source = pyvideo.load("test_media/test_video.mp4")
+        scheduler = PresentationScheduler(source, clock)
+
+        # Stepping the clock by a second at a time leaves most frames late
+        while now[0] < source.duration:
+            scheduler.update()
+            now[0] += 1.0
+        stats = scheduler.get_stats()
+        self.assertGreater(stats['presented'], 0)
+        self.assertGreater(stats['dropped'], stats['presented'])
+        self.assertLessEqual(stats['drift'], scheduler.drop_threshold)
+
+    def testShotDetection(self):
+        source = pyvideo.load("test_media/test_video.mp4")
+        boundaries = source.detect_shots(threshold=0.3)
+        timestamps = [boundary.timestamp for boundary in boundaries]
+        self.assertEqual(timestamps, sorted(timestamps))
+        for boundary in boundaries:
+            self.assertGreaterEqual(boundary.score, 0.3)
+            self.assertLessEqual(boundary.score, 1.0)
+
+        # The coarse pass only refines around cuts between keyframes
+        coarse = source.detect_shots(threshold=0.3, coarse=True)
+        self.assertLessEqual(len(coarse), len(boundaries))
+
+    def testFingerprint(self):
+        signature = fingerprint.compute_signature("test_media/test_video.mp4", rate=2)
+        self.assertEqual(len(signature), fingerprint.SEGMENTS)
+        keyframe_signature = fingerprint.compute_signature("test_media/test_video.mp4",
+                                                           keyframes=True)
+        self.assertEqual(len(keyframe_signature), fingerprint.SEGMENTS)
+
+        index = fingerprint.SignatureIndex()
+        index.add("seek", signature)
+        index.add("keyframes", keyframe_signature)
+        self.assertEqual(index.search(signature, limit=1), [("seek", 0)])
+        self.assertEqual(index.search(signature, max_distance=-1), [])
+
+        # Sampling reads forward, so no frame is decoded twice
+        source = pyvideo.load("test_media/test_video.mp4", skip_audio=True,
+                              skip_video=True)
+        frames = 0
+        while source.skip_video_frame() is not None:
+            frames += 1
+        decode = pyvideo.avbin.av.avbin_decode_video
+        decoded = []
+        def count_decode(*args):
+            decoded.append(args[2])
+            return decode(*args)
+        pyvideo.avbin.av.avbin_decode_video = count_decode
+        try:
+            fingerprint.compute_signature("test_media/test_video.mp4", rate=2)
+        finally:
+            pyvideo.avbin.av.avbin_decode_video = decode
+        self.assertLessEqual(len(decoded), frames)
+
+        # Frames smaller than the hash thumbnail are enlarged
+        tiny = bytearray(range(6 * 8 * 3))
+        frames = pyvideo.lib.load_numpy().frombuffer(tiny, 'uint8') \
+            .reshape(1, 6, 8, 3)
+        self.assertNotEqual(fingerprint.hash_frames(frames)[0], 0)
+
+    def testAudioConversion(self):
+        target = convert.make_format(1, SAMPLE_FORMAT_FLOAT, 48000)
+        source = pyvideo.load("test_media/test_video.mp4", audio_output=target)
+        self.assertEqual(source.audio_format, target)
+        self.assertEqual(source.native_audio_format.channels, 2)
+
+        audio_data = source.get_audio_data()
+        self.assertEqual(audio_data.length % 4, 0)
+        self.assertAlmostEqual(audio_data.duration,
+                               audio_data.length / float(target.bytes_per_second))
+
+    def testAudioResampling(self):
+        target = convert.make_format(1, SAMPLE_FORMAT_FLOAT, 16000)
+        source = pyvideo.load("test_media/test_video.mp4", audio_output=target)
+
+        samples = 0
+        end = None
+        while True:
+            audio_data = source.get_audio_data()
+            if audio_data is None:
+                break
+            # Chunks follow each other without gaps or overlaps
+            if end is not None:
+                self.assertAlmostEqual(audio_data.timestamp, end, places=4)
+            end = audio_data.timestamp + audio_data.duration
+            samples += audio_data.length / target.bytes_per_sample
+        self.assertAlmostEqual(samples / 16000., source.duration, places=1)
+
+        source.seek(5.0)
+        audio_data = source.get_audio_data()
+        self.assertAlmostEqual(audio_data.timestamp, 5.0, places=1)
+
+    def testMultipleStreams(self):
+        source = pyvideo.load("test_media/test_video.mp4", streams='all')
+        self.assertEqual(source.video_streams[:1], [0])
+        self.assertEqual(source.stream_formats[source.audio_streams[0]],
+                         source.audio_format)
+
+        # Reading one stream buffers the others of the same demux pass
+        audio_stream = source.audio_streams[-1]
+        audio_data = source.get_audio_data(audio_stream)
+        self.assertIsNotNone(audio_data)
+        timestamp = source.get_next_video_timestamp(source.video_streams[-1])
+        self.assertIsNotNone(timestamp)
+        self.assertIsNotNone(source.get_next_video_frame())
+        self.assertRaises(pyvideo.avbin.AVbinException,
+                          source.get_audio_data, source.video_streams[0])
+
+        source = pyvideo.load("test_media/test_video.mp4", streams=[0])
+        self.assertIsNone(source.audio_format)
+        self.assertIsNone(source.get_audio_data())
+
+    def testThreadedDecode(self):
+        source = pyvideo.load("test_media/test_video.mp4", skip_audio=True)
+        expected = len(list(source.iter_av()))
+
+        # Threads sharing a source each get whole, distinct frames
+        source.seek(0)
+        images = []
+        def read():
+            while True:
+                image = source.get_next_video_frame()
+                if image is None:
+                    return
+                images.append(image)
+        threads = [threading.Thread(target=read) for i in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(len(images), expected)
+
+        with DecodeEngine(workers=2, quantum=4) as engine:
+            frames = []
+            first = engine.decode_file("test_media/test_video.mp4",
+                                       callback=frames.append, skip_audio=True)
+            second = engine.decode_file("test_media/test_video.mp4")
+            self.assertGreater(len(list(second)), 0)
+            self.assertTrue(first.wait())
+        self.assertEqual(len(frames), expected)
+        self.assertRaises(AttributeError, setattr, frames[0], 'image', None)
+
+    def testCommandLine(self):
+        files = ["test_media/test_video.mp4", "test_media/test_video.mp4"]
+        output = subprocess.check_output(
+            [sys.executable, "-m", "pyvideo", "probe", "--jobs", "2"] + files)
+        records = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual(sorted(record["file"] for record in records), files)
+        self.assertIn("video", [stream["type"] for stream in records[0]["streams"]])
+
+        output = subprocess.check_output(
+            [sys.executable, "-m", "pyvideo", "bench", "--no-audio"] + files)
+        records = [json.loads(line) for line in output.splitlines()]
+        self.assertEqual(records[-1]["total"]["files"], 2)
+        self.assertGreater(records[-1]["total"]["frames"], 0)
+
     def tearDown(self):
         pass
 